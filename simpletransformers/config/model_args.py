@@ -409,6 +409,10 @@ class RetrievalArgs(Seq2SeqArgs):
     model_class: str = "RetrievalModel"
     ance_refresh_n_epochs: int = 1
     ance_training: bool = False
+    async_checkpointing: bool = False
+    beir_faiss_index: str = None
+    bf16: bool = False
+    cache_context_embeddings: bool = False
     cluster_concatenated: bool = False
     cluster_every_n_epochs: int = 1
     cluster_queries: bool = False
@@ -425,7 +429,9 @@ class RetrievalArgs(Seq2SeqArgs):
     extra_mask_token_count: int = 0
     faiss_clustering: bool = True
     faiss_index_type: str = "IndexFlatIP"
+    fused_triplet_loss: bool = False
     gradient_caching: bool = False
+    gradient_checkpointing: bool = False
     gradient_caching_steps: int = 16
     hard_negatives: bool = False
     hard_negatives_in_eval: bool = False
@@ -440,6 +446,8 @@ class RetrievalArgs(Seq2SeqArgs):
     kl_div_lambda: float = 1.0
     kmeans_k: int = -1
     larger_representations: bool = False
+    length_bucketing: bool = False
+    length_bucketing_n_buckets: int = 64
     margin_mse_lambda: float = 1
     mse_loss: bool = False
     moving_average_loss_count: int = 10
@@ -449,16 +457,23 @@ class RetrievalArgs(Seq2SeqArgs):
     nll_lambda_start_decay: int = None
     nll_lambda_min: float = None
     n_hard_negatives: int = 1
+    offload_context_activations: bool = False
     output_dropout: float = 0.1
+    overlap_encoder_streams: bool = False
     pytrec_eval_metrics: list = field(
         default_factory=lambda: ["recip_rank", "recall_100", "ndcg_cut_10", "ndcg"]
     )
+    qat_precisions: list = field(default_factory=list)
+    qat_weights: list = field(default_factory=list)
+    quantize_context_encoder: bool = False
+    quantize_dtype: str = "int8"
     query_config: dict = field(default_factory=dict)
     remove_duplicates_from_eval_passages: bool = False
     relevance_level: int = 1
     repeat_high_loss_n: int = 0
     rerank_batch_size: int = 256
     retrieval_batch_size: int = 2048
+    retrieval_quantize_embeddings: str = None
     retrieve_n_docs: int = 10
     save_clustering_idx: bool = False
     save_passage_dataset: bool = True
@@ -466,10 +481,13 @@ class RetrievalArgs(Seq2SeqArgs):
     tas_clustering: bool = False
     teacher_type: str = "colbert"
     tie_encoders: bool = False
+    torch_compile: bool = False
+    torch_compile_mode: str = "reduce-overhead"
     train_context_encoder: bool = True
     train_query_encoder: bool = True
     triplet_lambda: float = 1.0
     triplet_margin: float = 1.0
+    triplet_variant: str = "all"
     unified_rr: bool = False
     unified_cross_rr: bool = False
     use_autoencoder: bool = False
@@ -1,13 +1,18 @@
 from contextlib import nullcontext
+import copy
+import csv
 import json
 import logging
 import math
 import os
 import random
+import re
 import warnings
-import string
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
-from multiprocessing import Pool, cpu_count
+from functools import lru_cache, partial
+from itertools import chain
+from operator import itemgetter
 from pathlib import Path
 
 import numpy as np
@@ -16,7 +21,13 @@ import torch
 import transformers
 from torch.utils.tensorboard import SummaryWriter
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    SequentialSampler,
+)
 from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
 from tqdm.auto import tqdm, trange
@@ -69,15 +80,24 @@ from simpletransformers.retrieval.retrieval_utils import (
     get_tas_dataset,
     load_hf_dataset,
     get_evaluation_passage_dataset,
-    mean_reciprocal_rank_at_k,
-    get_recall_at_k,
     RetrievalOutput,
     load_trec_format,
     embed_passages_trec_format,
-    compute_rerank_similarity,
     MarginMSELoss,
     colbert_score,
+    fused_triplet_margin_loss,
+    fake_quantize,
     MovingLossAverage,
+    LengthBucketSampler,
+    get_sequence_lengths,
+    trim_padding,
+    maybe_no_sync,
+    copy_to_cpu,
+    dequantize_state_dict,
+    save_buffered,
+    normalize_passage,
+    prefetch_map,
+    record_stream,
 )
 from simpletransformers.retrieval.pytrec_eval_utils import (
     convert_predictions_to_pytrec_format,
@@ -97,6 +117,8 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+_CKPT_RE = re.compile(r"checkpoint-(\d+)(?:-epoch-\d+)?$")
+
 MODEL_CLASSES = {
     "dpr": (
         DPRConfig,
@@ -116,6 +138,9 @@ MODEL_CLASSES = {
 
 
 class RetrievalModel:
+    # Tokenizer post-processors keyed by (tokenizer, extra_cls_token_count, extra_mask_token_count)
+    _post_processor_cache = {}
+
     def __init__(
         self,
         model_type=None,
@@ -194,7 +219,8 @@ class RetrievalModel:
         self.results = {}
         self.unified_rr = self.args.unified_rr
 
-        if not use_cuda:
+        if not use_cuda or self.args.bf16:
+            # bf16 takes precedence over the (default on) fp16 so no GradScaler is used
             self.args.fp16 = False
 
         if self.args.larger_representations:
@@ -402,67 +428,26 @@ class RetrievalModel:
         # TODO: Add support for adding special tokens to the tokenizers
 
         if self.args.larger_representations or self.args.include_bce_loss:
-            from tokenizers.processors import TemplateProcessing
-
-            if self.args.extra_cls_token_count > 0:
-                cls_substring = (
-                    " ".join(["[CLS]"] * self.args.extra_cls_token_count) + " "
-                )
-
-                cls_substring = (
-                    " ".join(
-                        [f"[unused{i}]" for i in range(self.args.extra_cls_token_count)]
-                    )
-                    + " "
+            cache_key = (
+                self.context_tokenizer.name_or_path,
+                self.args.extra_cls_token_count,
+                self.args.extra_mask_token_count,
+            )
+            if cache_key not in RetrievalModel._post_processor_cache:
+                RetrievalModel._post_processor_cache[cache_key] = (
+                    self._build_post_processors()
                 )
 
-                special_tokens = [
-                    ("[CLS]", self.context_tokenizer.cls_token_id),
-                    ("[UNK]", self.context_tokenizer.unk_token_id),
-                    ("[SEP]", self.context_tokenizer.sep_token_id),
-                    ("[PAD]", self.context_tokenizer.pad_token_id),
-                    ("[MASK]", self.context_tokenizer.mask_token_id),
-                ]
-
-                for i in range(self.args.extra_cls_token_count):
-                    special_tokens.append(
-                        (
-                            f"[unused{i}]",
-                            self.context_tokenizer.convert_tokens_to_ids(
-                                f"[unused{i}]"
-                            ),
-                        )
-                    )
-
-                context_post_processor = TemplateProcessing(
-                    single=f"[CLS] {cls_substring}$A [SEP]",
-                    pair="[CLS] $A [SEP] $B:1 [SEP]:1",
-                    special_tokens=special_tokens,
-                )
+            (
+                context_post_processor,
+                query_post_processor,
+            ) = RetrievalModel._post_processor_cache[cache_key]
 
+            if context_post_processor is not None:
                 self.context_tokenizer._tokenizer.post_processor = (
                     context_post_processor
                 )
-            else:
-                cls_substring = ""
-
-            if self.args.extra_mask_token_count > 0:
-                mask_substring = (
-                    " ".join(["[MASK]"] * self.args.extra_mask_token_count) + " "
-                )
-            else:
-                mask_substring = ""
-
-            if (
-                self.args.extra_cls_token_count > 0
-                or self.args.extra_mask_token_count > 0
-            ):
-                query_post_processor = TemplateProcessing(
-                    single=f"[CLS] {cls_substring}$A {mask_substring}[SEP]",
-                    pair="[CLS] $A [SEP] $B:1 [SEP]:1",
-                    special_tokens=special_tokens,
-                )
-
+            if query_post_processor is not None:
                 self.query_tokenizer._tokenizer.post_processor = query_post_processor
 
         self.args.model_type = model_type
@@ -486,7 +471,150 @@ class RetrievalModel:
                 "Setting hard_negatives to True since ANCE training is enabled."
             )
 
+        if self.args.gradient_checkpointing:
+            # Only the context encoder, as passages are much longer than queries
+            try:
+                self.context_encoder.gradient_checkpointing_enable(
+                    gradient_checkpointing_kwargs={"use_reentrant": False}
+                )
+            except TypeError:
+                # gradient_checkpointing_kwargs was only added in transformers 4.35
+                self.context_encoder.gradient_checkpointing_enable()
+
+        if self.args.quantize_context_encoder:
+            self._quantize_context_encoder()
+
         self.eval_dataset_names = None
+        self._encoder_streams = None
+        self._checkpoint_executor = None
+        self._pending_save = None
+        self._cached_context_columns = None
+        self._arange_labels = {}
+        # Copies of the query encoder for the other GPUs, kept between predict() calls
+        self._query_replicas = None
+        # The loss modules hold no state, so they are created once instead of every step
+        self._margin_mse_criterion = MarginMSELoss()
+        self._kl_div_criterion = KLDivLossForTriplets()
+        self._set_autocast()
+        self._set_output_embedding_options()
+
+        # Output embedding sizes, resolved once instead of materializing config dicts
+        self._embedding_dim = (
+            getattr(self.query_config, "projection_dim", None)
+            or self.query_config.hidden_size
+        )
+        self._context_embedding_dim = (
+            getattr(self.context_config, "projection_dim", None)
+            or self.context_config.hidden_size
+        )
+
+    def _set_autocast(self):
+        """
+        Builds the autocast context factory once so that the hot loops don't have to
+        re-import torch.cuda.amp and branch on the precision flags at every step.
+        """
+        self._autocast = partial(
+            torch.autocast,
+            device_type=torch.device(self.device).type,
+            dtype=torch.float16 if self.args.fp16 else torch.bfloat16,
+            enabled=self.args.fp16 or self.args.bf16,
+        )
+
+    def _set_output_embedding_options(self):
+        """
+        Resolves the get_output_embeddings() options that only depend on args, once per
+        args update instead of on every forward pass.
+        """
+        self._concatenate_embeddings = bool(
+            self.args.larger_representations and self.args.model_type == "custom"
+        )
+        self._n_cls_tokens = 1 + self.args.extra_cls_token_count
+
+    def _quantize_context_encoder(self):
+        """
+        Applies post-training quantization to the context encoder. The quantized encoder is only
+        used to embed passages, so training of the context encoder is disabled.
+        """
+        if self.args.tie_encoders:
+            raise ValueError(
+                "quantize_context_encoder cannot be used when tie_encoders is True."
+            )
+
+        if self.args.quantize_dtype == "int8":
+            if self.device != "cpu":
+                raise ValueError(
+                    "int8 dynamic quantization is only supported on CPU."
+                    " Set use_cuda=False or use quantize_dtype='bf16'."
+                )
+            self.context_encoder = torch.ao.quantization.quantize_dynamic(
+                self.context_encoder, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        elif self.args.quantize_dtype == "bf16":
+            self.context_encoder = self.context_encoder.to(torch.bfloat16)
+        else:
+            raise ValueError(
+                f"Unsupported quantize_dtype: {self.args.quantize_dtype}."
+                " Supported values are 'int8' and 'bf16'."
+            )
+        self.context_encoder.eval()
+
+        if self.args.train_context_encoder:
+            self.args.train_context_encoder = False
+            warnings.warn(
+                "Setting train_context_encoder to False since the context encoder is quantized."
+            )
+
+    def _build_post_processors(self):
+        """
+        Builds the TemplateProcessing post-processors that insert the extra [CLS] and [MASK] tokens.
+        Returns a (context_post_processor, query_post_processor) tuple where either may be None.
+        """
+        from tokenizers.processors import TemplateProcessing
+
+        context_post_processor = None
+        query_post_processor = None
+
+        unused_tokens = [f"[unused{i}]" for i in range(self.args.extra_cls_token_count)]
+        special_tokens = [
+            ("[CLS]", self.context_tokenizer.cls_token_id),
+            ("[UNK]", self.context_tokenizer.unk_token_id),
+            ("[SEP]", self.context_tokenizer.sep_token_id),
+            ("[PAD]", self.context_tokenizer.pad_token_id),
+            ("[MASK]", self.context_tokenizer.mask_token_id),
+        ]
+        if unused_tokens:
+            special_tokens.extend(
+                zip(
+                    unused_tokens,
+                    self.context_tokenizer.convert_tokens_to_ids(unused_tokens),
+                )
+            )
+
+        if self.args.extra_cls_token_count > 0:
+            cls_substring = " ".join(unused_tokens) + " "
+            context_post_processor = TemplateProcessing(
+                single=f"[CLS] {cls_substring}$A [SEP]",
+                pair="[CLS] $A [SEP] $B:1 [SEP]:1",
+                special_tokens=special_tokens,
+            )
+        else:
+            cls_substring = ""
+
+        if self.args.extra_mask_token_count > 0:
+            mask_substring = (
+                " ".join(["[MASK]"] * self.args.extra_mask_token_count) + " "
+            )
+        else:
+            mask_substring = ""
+
+        if self.args.extra_cls_token_count > 0 or self.args.extra_mask_token_count > 0:
+            query_post_processor = TemplateProcessing(
+                single=f"[CLS] {cls_substring}$A {mask_substring}[SEP]",
+                pair="[CLS] $A [SEP] $B:1 [SEP]:1",
+                special_tokens=special_tokens,
+            )
+
+        return context_post_processor, query_post_processor
 
     def train_model(
         self,
@@ -536,6 +664,10 @@ class RetrievalModel:
 
         if args:
             self.args.update_from_dict(args)
+            if self.args.bf16:
+                self.args.fp16 = False
+            self._set_autocast()
+        self._set_output_embedding_options()
 
         # if self.args.silent:
         #     show_running_loss = False
@@ -589,15 +721,24 @@ class RetrievalModel:
         if self.args.ddp_training:
             self.context_encoder = self.context_encoder.to(kwargs["rank"])
             self.query_encoder = self.query_encoder.to(kwargs["rank"])
+            # Gradients alias the DDP all-reduce buckets instead of being copied in and out
             self.context_encoder = DDP(
-                self.context_encoder, device_ids=[kwargs["rank"]]
+                self.context_encoder,
+                device_ids=[kwargs["rank"]],
+                gradient_as_bucket_view=True,
+            )
+            self.query_encoder = DDP(
+                self.query_encoder,
+                device_ids=[kwargs["rank"]],
+                gradient_as_bucket_view=True,
             )
-            self.query_encoder = DDP(self.query_encoder, device_ids=[kwargs["rank"]])
             self.device = kwargs["rank"]
             if self.unified_rr:
                 self.teacher_model = self.teacher_model.to(kwargs["rank"])
                 self.teacher_model = DDP(
-                    self.teacher_model, device_ids=[kwargs["rank"]]
+                    self.teacher_model,
+                    device_ids=[kwargs["rank"]],
+                    gradient_as_bucket_view=True,
                 )
         else:
             self._move_model_to_device()
@@ -632,6 +773,7 @@ class RetrievalModel:
             context_model=self.context_encoder,
             query_model=self.query_encoder,
         )
+        self._wait_for_pending_saves()
 
         if verbose:
             logger.info(
@@ -668,7 +810,26 @@ class RetrievalModel:
         args = self.args
 
         tb_writer = SummaryWriter(log_dir=args.tensorboard_dir)
-        train_sampler = RandomSampler(train_dataset)
+
+        self._cached_context_columns = None
+        if args.cache_context_embeddings and not args.train_context_encoder:
+            if (
+                clustered_training
+                or args.tas_clustering
+                or args.ance_training
+                or args.external_embeddings
+                or args.use_autoencoder
+            ):
+                warnings.warn(
+                    "cache_context_embeddings is not supported with clustered training, ANCE training,"
+                    " external embeddings or autoencoders. Context embeddings will not be cached."
+                )
+            else:
+                train_dataset = self._cache_context_embeddings(
+                    train_dataset, context_model
+                )
+
+        train_sampler = self._get_train_sampler(train_dataset)
 
         if clustered_training or args.tas_clustering:
             train_dataloader = train_dataset
@@ -687,12 +848,7 @@ class RetrievalModel:
             else:
                 randomize_percentage = np.zeros(args.num_train_epochs)
         else:
-            train_dataloader = DataLoader(
-                train_dataset,
-                sampler=train_sampler,
-                batch_size=args.train_batch_size,
-                num_workers=self.args.dataloader_num_workers,
-            )
+            train_dataloader = self._get_train_dataloader(train_dataset, train_sampler)
 
         if args.max_steps > 0:
             t_total = args.max_steps
@@ -724,11 +880,16 @@ class RetrievalModel:
         )
 
         if args.optimizer == "AdamW":
+            # A single fused kernel on CUDA, otherwise the multi-tensor foreach path
+            # rather than the per-parameter loop
+            use_fused_adamw = torch.device(self.device).type == "cuda"
             optimizer = AdamW(
                 optimizer_grouped_parameters,
                 lr=args.learning_rate,
                 eps=args.adam_epsilon,
                 betas=args.adam_betas,
+                fused=use_fused_adamw,
+                foreach=not use_fused_adamw,
             )
         elif args.optimizer == "Adafactor":
             optimizer = Adafactor(
@@ -752,33 +913,50 @@ class RetrievalModel:
 
         scheduler = self.get_scheduler(optimizer, args, t_total)
 
-        criterion = torch.nn.NLLLoss(reduction="mean")
-
         if (
             args.model_name
             and os.path.isfile(os.path.join(args.model_name, "optimizer.pt"))
             and os.path.isfile(os.path.join(args.model_name, "scheduler.pt"))
         ):
             # Load in optimizer and scheduler states
+            # The state is memory-mapped and copied to the parameter devices by load_state_dict
             optimizer.load_state_dict(
-                torch.load(os.path.join(args.model_name, "optimizer.pt"))
+                torch.load(
+                    os.path.join(args.model_name, "optimizer.pt"),
+                    map_location="cpu",
+                    mmap=True,
+                    weights_only=True,
+                )
             )
             scheduler.load_state_dict(
-                torch.load(os.path.join(args.model_name, "scheduler.pt"))
+                torch.load(
+                    os.path.join(args.model_name, "scheduler.pt"),
+                    map_location="cpu",
+                    weights_only=True,
+                )
             )
 
-        if args.n_gpu > 1:
+        if args.n_gpu > 1 and not args.ddp_training:
+            warnings.warn(
+                "Training on multiple GPUs with torch.nn.DataParallel re-replicates the encoders"
+                " on every step. Set ddp_training to True for a faster multi-GPU setup."
+            )
             context_model = torch.nn.DataParallel(context_model)
             query_model = torch.nn.DataParallel(query_model)
-            self.teacher_model = torch.nn.DataParallel(self.teacher_model)
+            if self.teacher_model is not None and not isinstance(
+                self.teacher_model, torch.nn.DataParallel
+            ):
+                self.teacher_model = torch.nn.DataParallel(self.teacher_model)
 
         logger.info(" Training started")
 
         self.global_step = 0
         training_progress_scores = None
-        tr_loss, logging_loss = 0.0, 0.0
-        context_model.zero_grad()
-        query_model.zero_grad()
+        # Accumulated on the device and only copied to the host when logging
+        tr_loss = torch.zeros((), device=self.device)
+        logging_loss = 0.0
+        context_model.zero_grad(set_to_none=True)
+        query_model.zero_grad(set_to_none=True)
         train_iterator = trange(
             int(args.num_train_epochs), desc="Epoch", disable=args.silent, mininterval=0
         )
@@ -790,14 +968,10 @@ class RetrievalModel:
         moving_loss = MovingLossAverage(args.moving_average_loss_count)
 
         if args.model_name and os.path.exists(args.model_name):
-            try:
-                # set global_step to gobal_step of last saved checkpoint from model path
-                checkpoint_suffix = args.model_name.split("/")[-1].split("-")
-                if len(checkpoint_suffix) > 2:
-                    checkpoint_suffix = checkpoint_suffix[1]
-                else:
-                    checkpoint_suffix = checkpoint_suffix[-1]
-                self.global_step = int(checkpoint_suffix)
+            # set global_step to gobal_step of last saved checkpoint from model path
+            checkpoint_match = _CKPT_RE.search(args.model_name.rstrip("/"))
+            if checkpoint_match:
+                self.global_step = int(checkpoint_match.group(1))
                 epochs_trained = (
                     self.global_step
                     // (len(train_dataloader) // args.gradient_accumulation_steps)
@@ -825,7 +999,7 @@ class RetrievalModel:
                     disable=args.silent,
                     mininterval=0,
                 )
-            except ValueError:
+            else:
                 logger.info("   Starting fine-tuning.")
 
         if args.evaluate_during_training:
@@ -852,6 +1026,7 @@ class RetrievalModel:
             wandb.run._label(repo="simpletransformers")
             wandb.watch(context_model)
             wandb.watch(query_model)
+        wandb_active = bool(args.wandb_project) or self.is_sweeping
 
         if args.fp16:
             from torch.cuda import amp
@@ -861,6 +1036,27 @@ class RetrievalModel:
         if args.external_embeddings:
             args.train_context_encoder = False
 
+        # Gradients of both encoders are clipped together in a single foreach norm/scale pass
+        if args.tie_encoders:
+            clip_parameters = list(context_model.parameters())
+        else:
+            clip_parameters = list(
+                chain(context_model.parameters(), query_model.parameters())
+            )
+
+        if args.torch_compile:
+            # The step includes both encoder forward passes. Batches are padded to
+            # max_seq_length unless length bucketing trims them, so only then are
+            # dynamic shapes needed (static shapes let reduce-overhead use CUDA graphs).
+            train_step = torch.compile(
+                self._train_step,
+                mode=args.torch_compile_mode,
+                fullgraph=False,
+                dynamic=args.length_bucketing,
+            )
+        else:
+            train_step = self._train_step
+
         for current_epoch in train_iterator:
             if args.train_context_encoder:
                 context_model.train()
@@ -898,27 +1094,16 @@ class RetrievalModel:
                     true_n_scores,
                 ) = self._get_inputs_dict(batch)
 
-                high_loss_repeats = 0
+                # Skip the DDP gradient all-reduce on all but the last accumulation micro-step
+                sync_gradients = (
+                    args.repeat_high_loss_n > 0
+                    or (step + 1) % args.gradient_accumulation_steps == 0
+                )
+                with maybe_no_sync((context_model, query_model), sync_gradients):
+                    high_loss_repeats = 0
 
-                while True:
-                    if args.fp16:
-                        with amp.autocast():
-                            retrieval_output = self._calculate_loss(
-                                context_model,
-                                query_model,
-                                context_inputs,
-                                query_inputs,
-                                labels,
-                                margins=margins,
-                                true_p_scores=true_p_scores,
-                                true_n_scores=true_n_scores,
-                            )
-                            loss = retrieval_output.loss
-                            correct_predictions_percentage = (
-                                retrieval_output.correct_predictions_percentage
-                            )
-                    else:
-                        retrieval_output = self._calculate_loss(
+                    while True:
+                        retrieval_output = train_step(
                             context_model,
                             query_model,
                             context_inputs,
@@ -932,90 +1117,103 @@ class RetrievalModel:
                         correct_predictions_percentage = (
                             retrieval_output.correct_predictions_percentage
                         )
-                    colbert_percentage = (
-                        retrieval_output.teacher_correct_predictions_percentage
-                    )
-
-                    if args.n_gpu > 1:
-                        loss = loss.mean()
+                        colbert_percentage = (
+                            retrieval_output.teacher_correct_predictions_percentage
+                        )
+                        step_nll_loss = retrieval_output.nll_loss
+                        if torch.is_tensor(step_nll_loss):
+                            step_nll_loss = step_nll_loss.detach()
+                        # Only the loss is needed from here on. Dropping the output
+                        # embeddings lets the allocator reuse their memory during the
+                        # backward pass and the next forward pass.
+                        del retrieval_output
 
-                    # Compare the current loss to the moving average loss
-                    current_loss = loss.item()
+                        if args.n_gpu > 1:
+                            loss = loss.mean()
 
-                    if (
-                        args.repeat_high_loss_n == 0
-                        or moving_loss.size() < args.moving_average_loss_count
-                    ):
-                        break
+                        if (
+                            args.repeat_high_loss_n == 0
+                            or moving_loss.size() < args.moving_average_loss_count
+                        ):
+                            break
 
-                    if current_loss > moving_loss.get_average_loss():
-                        # Increment the high loss repeats counter
-                        high_loss_repeats += 1
+                        # Compare the current loss to the moving average loss
+                        if loss.item() > moving_loss.get_average_loss():
+                            # Increment the high loss repeats counter
+                            high_loss_repeats += 1
 
-                        if high_loss_repeats > args.repeat_high_loss_n:
-                            # Exit the loop if the high loss repeats counter exceeds the threshold
-                            break
-                        if args.fp16:
-                            scaler.scale(loss).backward()
-                        else:
-                            loss.backward()
+                            if high_loss_repeats > args.repeat_high_loss_n:
+                                # Exit the loop if the high loss repeats counter exceeds the threshold
+                                break
+                            if args.fp16:
+                                scaler.scale(loss).backward()
+                            else:
+                                loss.backward()
 
-                        if args.fp16:
-                            scaler.unscale_(optimizer)
-                        if args.optimizer == "AdamW":
-                            torch.nn.utils.clip_grad_norm_(
-                                context_model.parameters(), args.max_grad_norm
-                            )
-                            torch.nn.utils.clip_grad_norm_(
-                                query_model.parameters(), args.max_grad_norm
-                            )
+                            if args.fp16:
+                                scaler.unscale_(optimizer)
+                            if args.optimizer == "AdamW":
+                                torch.nn.utils.clip_grad_norm_(
+                                    clip_parameters, args.max_grad_norm
+                                )
 
-                        if args.fp16:
-                            scaler.step(optimizer)
-                            scaler.update()
+                            if args.fp16:
+                                scaler.step(optimizer)
+                                scaler.update()
+                            else:
+                                optimizer.step()
+                                context_model.zero_grad(set_to_none=True)
+                                query_model.zero_grad(set_to_none=True)
                         else:
-                            optimizer.step()
-                            context_model.zero_grad()
-                            query_model.zero_grad()
-                    else:
-                        # Exit the loop if the current loss is lower than the moving average loss
-                        break
+                            # Exit the loop if the current loss is lower than the moving average loss
+                            break
 
-                if args.repeat_high_loss_n > 0:
-                    moving_loss.add_loss(current_loss)
+                    # Only copied to the host when needed, as .item() syncs with the device
+                    step_loss = loss.detach()
 
-                if show_running_loss and (args.reranking_kl_div_loss or args.mse_loss):
-                    batch_iterator.set_description(
-                        f"Epochs {epoch_number + 1}/{args.num_train_epochs}. Running Loss: {current_loss:9.4f} Correct percentage: {correct_predictions_percentage:4.1f} Teacher correct percentage: {colbert_percentage:4.1f}"
-                    )
-                elif show_running_loss:
                     if args.repeat_high_loss_n > 0:
-                        batch_iterator.set_description(
-                            f"Epochs {epoch_number + 1}/{args.num_train_epochs}. Running Loss: {current_loss:9.4f} Correct percentage: {correct_predictions_percentage:4.1f} High loss repeats: {high_loss_repeats}"
+                        moving_loss.add_loss(step_loss.item())
+
+                    update_description = show_running_loss and (
+                        args.logging_steps <= 0 or step % args.logging_steps == 0
+                    )
+                    if update_description:
+                        current_loss = step_loss.item()
+                        correct_predictions_percentage = float(
+                            correct_predictions_percentage
                         )
-                    else:
+                        if colbert_percentage is not None:
+                            colbert_percentage = float(colbert_percentage)
+
+                    if update_description and colbert_percentage is not None:
                         batch_iterator.set_description(
-                            f"Epochs {epoch_number + 1}/{args.num_train_epochs}. Running Loss: {current_loss:9.4f} Correct percentage: {correct_predictions_percentage:4.1f}"
+                            f"Epochs {epoch_number + 1}/{args.num_train_epochs}. Running Loss: {current_loss:9.4f} Correct percentage: {correct_predictions_percentage:4.1f} Teacher correct percentage: {colbert_percentage:4.1f}"
                         )
+                    elif update_description:
+                        if args.repeat_high_loss_n > 0:
+                            batch_iterator.set_description(
+                                f"Epochs {epoch_number + 1}/{args.num_train_epochs}. Running Loss: {current_loss:9.4f} Correct percentage: {correct_predictions_percentage:4.1f} High loss repeats: {high_loss_repeats}"
+                            )
+                        else:
+                            batch_iterator.set_description(
+                                f"Epochs {epoch_number + 1}/{args.num_train_epochs}. Running Loss: {current_loss:9.4f} Correct percentage: {correct_predictions_percentage:4.1f}"
+                            )
 
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
+                    if args.gradient_accumulation_steps > 1:
+                        loss = loss / args.gradient_accumulation_steps
 
-                if args.fp16:
-                    scaler.scale(loss).backward()
-                else:
-                    loss.backward()
+                    if args.fp16:
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
 
-                tr_loss += loss.item()
+                tr_loss += loss.detach()
                 if (step + 1) % args.gradient_accumulation_steps == 0:
                     if args.fp16:
                         scaler.unscale_(optimizer)
                     if args.optimizer == "AdamW":
                         torch.nn.utils.clip_grad_norm_(
-                            context_model.parameters(), args.max_grad_norm
-                        )
-                        torch.nn.utils.clip_grad_norm_(
-                            query_model.parameters(), args.max_grad_norm
+                            clip_parameters, args.max_grad_norm
                         )
 
                     if args.fp16:
@@ -1024,8 +1222,8 @@ class RetrievalModel:
                     else:
                         optimizer.step()
                     scheduler.step()  # Update learning rate schedule
-                    context_model.zero_grad()
-                    query_model.zero_grad()
+                    context_model.zero_grad(set_to_none=True)
+                    query_model.zero_grad(set_to_none=True)
                     self.global_step += 1
 
                     if (
@@ -1033,50 +1231,57 @@ class RetrievalModel:
                         and self.global_step % args.logging_steps == 0
                     ):
                         # Log metrics
-                        tb_writer.add_scalar(
-                            "lr", scheduler.get_last_lr()[0], self.global_step
-                        )
+                        current_loss = step_loss.item()
+                        tr_loss_value = tr_loss.item()
+                        last_lr = scheduler.get_last_lr()[0]
+                        tb_writer.add_scalar("lr", last_lr, self.global_step)
                         tb_writer.add_scalar(
                             "loss",
-                            (tr_loss - logging_loss) / args.logging_steps,
+                            (tr_loss_value - logging_loss) / args.logging_steps,
                             self.global_step,
                         )
-                        logging_loss = tr_loss
-                        if args.wandb_project or self.is_sweeping:
+                        logging_loss = tr_loss_value
+                        if wandb_active:
+                            # Only synced with the device here, when it is actually logged
+                            nll_loss = step_nll_loss
+                            if torch.is_tensor(nll_loss):
+                                nll_loss = nll_loss.item()
+                            correct_predictions_percentage = float(
+                                correct_predictions_percentage
+                            )
+                            if colbert_percentage is not None:
+                                colbert_percentage = float(colbert_percentage)
                             if self.unified_rr:
                                 logging_dict = {
                                     "Training loss": current_loss,
-                                    "lr": scheduler.get_last_lr()[0],
+                                    "lr": last_lr,
                                     "global_step": self.global_step,
                                     "correct_predictions_percentage": correct_predictions_percentage,
-                                    "reranking_loss": retrieval_output.reranking_loss,
-                                    "nll_loss": retrieval_output.nll_loss,
+                                    "nll_loss": nll_loss,
                                 }
                             else:
                                 if args.reranking_kl_div_loss or args.mse_loss:
                                     logging_dict = {
                                         "Training loss": current_loss,
-                                        "lr": scheduler.get_last_lr()[0],
+                                        "lr": last_lr,
                                         "global_step": self.global_step,
                                         "correct_predictions_percentage": correct_predictions_percentage,
                                         "teacher_correct_predictions_percentage": colbert_percentage,
                                     }
                                     if args.include_nll_loss:
-                                        logging_dict[
-                                            "nll_loss"
-                                        ] = retrieval_output.nll_loss
+                                        logging_dict["nll_loss"] = nll_loss
                                         if args.reranking_kl_div_loss:
                                             logging_dict["kl_div_loss"] = (
-                                                current_loss - retrieval_output.nll_loss
+                                                current_loss - nll_loss
                                             )
                                         elif args.mse_loss:
                                             logging_dict["mse_loss"] = (
-                                                current_loss - retrieval_output.nll_loss
+                                                current_loss - nll_loss
                                             )
                                 else:
                                     logging_dict = {
                                         "Training loss": current_loss,
-                                        "lr": scheduler.get_last_lr()[0],
+                                        "lr": last_lr,
                                         "global_step": self.global_step,
                                         "correct_predictions_percentage": correct_predictions_percentage,
                                     }
@@ -1168,123 +1373,38 @@ class RetrievalModel:
                             )
 
                         training_progress_scores["global_step"].append(self.global_step)
-                        training_progress_scores["train_loss"].append(current_loss)
-                        for key in results:
-                            training_progress_scores[key].append(results[key])
-                        report = pd.DataFrame(training_progress_scores)
-                        report.to_csv(
-                            os.path.join(
-                                args.output_dir, "training_progress_scores.csv"
-                            ),
-                            index=False,
-                        )
+                        training_progress_scores["train_loss"].append(step_loss.item())
+                        for key, value in results.items():
+                            training_progress_scores[key].append(value)
+                        self._write_training_progress_row(training_progress_scores)
 
-                        if args.wandb_project or self.is_sweeping:
+                        if wandb_active:
                             wandb.log(self._get_last_metrics(training_progress_scores))
 
-                        if not best_eval_metric:
-                            best_eval_metric = results[args.early_stopping_metric]
-                            if args.save_best_model:
-                                self.save_model(
-                                    args.best_model_dir,
-                                    optimizer,
-                                    scheduler,
-                                    context_model=context_model,
-                                    query_model=query_model,
-                                    results=results,
-                                )
-                        if best_eval_metric and args.early_stopping_metric_minimize:
-                            if (
-                                results[args.early_stopping_metric] - best_eval_metric
-                                < args.early_stopping_delta
-                            ):
-                                best_eval_metric = results[args.early_stopping_metric]
-                                if args.save_best_model:
-                                    self.save_model(
-                                        args.best_model_dir,
-                                        optimizer,
-                                        scheduler,
-                                        context_model=context_model,
-                                        query_model=query_model,
-                                        results=results,
-                                    )
-                                early_stopping_counter = 0
-                            else:
-                                if args.use_early_stopping:
-                                    if (
-                                        early_stopping_counter
-                                        < args.early_stopping_patience
-                                    ):
-                                        early_stopping_counter += 1
-                                        if verbose:
-                                            logger.info(
-                                                f" No improvement in {args.early_stopping_metric}"
-                                            )
-                                            logger.info(
-                                                f" Current step: {early_stopping_counter}"
-                                            )
-                                            logger.info(
-                                                f" Early stopping patience: {args.early_stopping_patience}"
-                                            )
-                                    else:
-                                        if verbose:
-                                            logger.info(
-                                                f" Patience of {args.early_stopping_patience} steps reached"
-                                            )
-                                            logger.info(" Training terminated.")
-                                            train_iterator.close()
-                                        return (
-                                            self.global_step,
-                                            tr_loss / self.global_step
-                                            if not self.args.evaluate_during_training
-                                            else training_progress_scores,
-                                        )
-                        else:
-                            if (
-                                results[args.early_stopping_metric] - best_eval_metric
-                                > args.early_stopping_delta
-                            ):
-                                best_eval_metric = results[args.early_stopping_metric]
-                                if args.save_best_model:
-                                    self.save_model(
-                                        args.best_model_dir,
-                                        optimizer,
-                                        scheduler,
-                                        context_model=context_model,
-                                        query_model=query_model,
-                                        results=results,
-                                    )
-                                early_stopping_counter = 0
-                            else:
-                                if args.use_early_stopping:
-                                    if (
-                                        early_stopping_counter
-                                        < args.early_stopping_patience
-                                    ):
-                                        early_stopping_counter += 1
-                                        if verbose:
-                                            logger.info(
-                                                f" No improvement in {args.early_stopping_metric}"
-                                            )
-                                            logger.info(
-                                                f" Current step: {early_stopping_counter}"
-                                            )
-                                            logger.info(
-                                                f" Early stopping patience: {args.early_stopping_patience}"
-                                            )
-                                    else:
-                                        if verbose:
-                                            logger.info(
-                                                f" Patience of {args.early_stopping_patience} steps reached"
-                                            )
-                                            logger.info(" Training terminated.")
-                                            train_iterator.close()
-                                        return (
-                                            self.global_step,
-                                            tr_loss / self.global_step
-                                            if not self.args.evaluate_during_training
-                                            else training_progress_scores,
-                                        )
+                        (
+                            best_eval_metric,
+                            early_stopping_counter,
+                            stop_training,
+                        ) = self._update_best_and_maybe_stop(
+                            results,
+                            best_eval_metric,
+                            early_stopping_counter,
+                            context_model,
+                            query_model,
+                            optimizer,
+                            scheduler,
+                            consider_epochs=False,
+                            verbose=verbose,
+                        )
+                        if stop_training:
+                            if verbose:
+                                train_iterator.close()
+                            return (
+                                self.global_step,
+                                tr_loss.item() / self.global_step
+                                if not self.args.evaluate_during_training
+                                else training_progress_scores,
+                            )
                         context_model.train()
                         query_model.train()
 
@@ -1311,15 +1431,12 @@ class RetrievalModel:
                     epoch_number=epoch_number,
                     dataset=train_dataset,
                 )
-                train_sampler = RandomSampler(train_dataset)
+                train_sampler = self._get_train_sampler(train_dataset)
                 if clustered_training:
                     train_dataloader = train_dataset
                 else:
-                    train_dataloader = DataLoader(
-                        train_dataset,
-                        sampler=train_sampler,
-                        batch_size=args.train_batch_size,
-                        num_workers=self.args.dataloader_num_workers,
+                    train_dataloader = self._get_train_dataloader(
+                        train_dataset, train_sampler
                     )
 
             if args.save_model_every_epoch or args.evaluate_during_training:
@@ -1384,126 +1501,43 @@ class RetrievalModel:
                     )
 
                 training_progress_scores["global_step"].append(self.global_step)
-                training_progress_scores["train_loss"].append(current_loss)
-                for key in results:
-                    training_progress_scores[key].append(results[key])
+                training_progress_scores["train_loss"].append(step_loss.item())
+                for key, value in results.items():
+                    training_progress_scores[key].append(value)
 
-                report = pd.DataFrame(training_progress_scores)
-                report.to_csv(
-                    os.path.join(args.output_dir, "training_progress_scores.csv"),
-                    index=False,
-                )
+                self._write_training_progress_row(training_progress_scores)
 
-                if args.wandb_project or self.is_sweeping:
+                if wandb_active:
                     wandb.log(self._get_last_metrics(training_progress_scores))
 
-                if not best_eval_metric:
-                    best_eval_metric = results[args.early_stopping_metric]
-                    if args.save_best_model:
-                        self.save_model(
-                            args.best_model_dir,
-                            optimizer,
-                            scheduler,
-                            context_model=context_model,
-                            query_model=query_model,
-                            results=results,
-                        )
-                if best_eval_metric and args.early_stopping_metric_minimize:
-                    if (
-                        results[args.early_stopping_metric] - best_eval_metric
-                        < args.early_stopping_delta
-                    ):
-                        best_eval_metric = results[args.early_stopping_metric]
-                        if args.save_best_model:
-                            self.save_model(
-                                args.best_model_dir,
-                                optimizer,
-                                scheduler,
-                                context_model=context_model,
-                                query_model=query_model,
-                                results=results,
-                            )
-                        early_stopping_counter = 0
-                    else:
-                        if (
-                            args.use_early_stopping
-                            and args.early_stopping_consider_epochs
-                        ):
-                            if early_stopping_counter < args.early_stopping_patience:
-                                early_stopping_counter += 1
-                                if verbose:
-                                    logger.info(
-                                        f" No improvement in {args.early_stopping_metric}"
-                                    )
-                                    logger.info(
-                                        f" Current step: {early_stopping_counter}"
-                                    )
-                                    logger.info(
-                                        f" Early stopping patience: {args.early_stopping_patience}"
-                                    )
-                            else:
-                                if verbose:
-                                    logger.info(
-                                        f" Patience of {args.early_stopping_patience} steps reached"
-                                    )
-                                    logger.info(" Training terminated.")
-                                    train_iterator.close()
-                                return (
-                                    self.global_step,
-                                    tr_loss / self.global_step
-                                    if not self.args.evaluate_during_training
-                                    else training_progress_scores,
-                                )
-                else:
-                    if (
-                        results[args.early_stopping_metric] - best_eval_metric
-                        > args.early_stopping_delta
-                    ):
-                        best_eval_metric = results[args.early_stopping_metric]
-                        if args.save_best_model:
-                            self.save_model(
-                                args.best_model_dir,
-                                optimizer,
-                                scheduler,
-                                context_model=context_model,
-                                query_model=query_model,
-                                results=results,
-                            )
-                        early_stopping_counter = 0
-                    else:
-                        if (
-                            args.use_early_stopping
-                            and args.early_stopping_consider_epochs
-                        ):
-                            if early_stopping_counter < args.early_stopping_patience:
-                                early_stopping_counter += 1
-                                if verbose:
-                                    logger.info(
-                                        f" No improvement in {args.early_stopping_metric}"
-                                    )
-                                    logger.info(
-                                        f" Current step: {early_stopping_counter}"
-                                    )
-                                    logger.info(
-                                        f" Early stopping patience: {args.early_stopping_patience}"
-                                    )
-                            else:
-                                if verbose:
-                                    logger.info(
-                                        f" Patience of {args.early_stopping_patience} steps reached"
-                                    )
-                                    logger.info(" Training terminated.")
-                                    train_iterator.close()
-                                return (
-                                    self.global_step,
-                                    tr_loss / self.global_step
-                                    if not self.args.evaluate_during_training
-                                    else training_progress_scores,
-                                )
+                (
+                    best_eval_metric,
+                    early_stopping_counter,
+                    stop_training,
+                ) = self._update_best_and_maybe_stop(
+                    results,
+                    best_eval_metric,
+                    early_stopping_counter,
+                    context_model,
+                    query_model,
+                    optimizer,
+                    scheduler,
+                    consider_epochs=True,
+                    verbose=verbose,
+                )
+                if stop_training:
+                    if verbose:
+                        train_iterator.close()
+                    return (
+                        self.global_step,
+                        tr_loss.item() / self.global_step
+                        if not self.args.evaluate_during_training
+                        else training_progress_scores,
+                    )
 
         return (
             self.global_step,
-            tr_loss / self.global_step
+            tr_loss.item() / self.global_step
             if not self.args.evaluate_during_training
             else training_progress_scores,
         )
@@ -1845,40 +1879,40 @@ class RetrievalModel:
 
         eval_sampler = SequentialSampler(eval_dataset)
         eval_dataloader = DataLoader(
-            eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size
+            eval_dataset,
+            sampler=eval_sampler,
+            batch_size=args.eval_batch_size,
+            pin_memory=torch.device(self.device).type == "cuda",
         )
 
-        if args.n_gpu > 1:
-            context_model = torch.nn.DataParallel(context_model)
-            query_model = torch.nn.DataParallel(query_model)
-            self.teacher_model = torch.nn.DataParallel(self.teacher_model)
-
+        # Only the (short) evaluation queries are encoded here, so no DataParallel replication.
+        # The passage embeddings are already sharded across GPUs in get_evaluation_passage_dataset.
         nb_eval_steps = 0
-        eval_loss = 0
+        eval_loss = torch.zeros((), device=self.device)
         context_model.eval()
         query_model.eval()
 
-        criterion = torch.nn.NLLLoss(reduction="mean")
-
-        if self.args.fp16:
-            from torch.cuda import amp
-
+        # float32 to match the FAISS index, so no float64 buffer or later cast is needed.
+        # On GPU the buffer is pinned so that each batch is copied back asynchronously.
+        # Every row is written by the loop, so the buffer is left uninitialized.
+        pin_query_embeddings = torch.device(self.device).type == "cuda"
         if args.larger_representations:
-            all_query_embeddings = np.zeros(
+            all_query_embeddings = torch.empty(
                 (
                     len(eval_dataset),
                     self.query_config.hidden_size * (1 + args.extra_cls_token_count),
-                )
+                ),
+                dtype=torch.float32,
+                pin_memory=pin_query_embeddings,
             )
         else:
-            all_query_embeddings = np.zeros(
+            all_query_embeddings = torch.empty(
                 (
                     len(eval_dataset),
-                    self.query_config.hidden_size
-                    if "projection_dim" not in self.query_config.to_dict()
-                    or not self.query_config.projection_dim
-                    else self.query_config.projection_dim,
-                )
+                    self._embedding_dim,
+                ),
+                dtype=torch.float32,
+                pin_memory=pin_query_embeddings,
             )
         for i, batch in enumerate(
             tqdm(
@@ -1889,40 +1923,33 @@ class RetrievalModel:
         ):
             # batch = tuple(t.to(device) for t in batch)
 
-            context_inputs, query_inputs, labels, _ = self._get_inputs_dict(
+            context_inputs, query_inputs, labels, *_ = self._get_inputs_dict(
                 batch, evaluate=True
             )
-            with torch.no_grad():
-                if self.args.fp16:
-                    with amp.autocast():
-                        retrieval_outputs = self._calculate_loss(
-                            context_model,
-                            query_model,
-                            context_inputs,
-                            query_inputs,
-                            labels,
-                        )
-                else:
-                    retrieval_outputs = self._calculate_loss(
-                        context_model,
-                        query_model,
-                        context_inputs,
-                        query_inputs,
-                        labels,
-                    )
+            with torch.inference_mode(), self._autocast():
+                retrieval_outputs = self._calculate_loss(
+                    context_model,
+                    query_model,
+                    context_inputs,
+                    query_inputs,
+                    labels,
+                )
 
                 tmp_eval_loss = retrieval_outputs.loss
                 query_outputs = retrieval_outputs.query_outputs
-                if self.args.n_gpu > 1:
-                    tmp_eval_loss = tmp_eval_loss.mean()
 
-                eval_loss += tmp_eval_loss.item()
+                eval_loss += tmp_eval_loss
                 all_query_embeddings[
                     i * args.eval_batch_size : (i + 1) * args.eval_batch_size
-                ] = (query_outputs.cpu().detach().numpy())
+                ].copy_(query_outputs.float(), non_blocking=True)
             nb_eval_steps += 1
 
-        eval_loss = eval_loss / nb_eval_steps
+        if pin_query_embeddings:
+            # Wait for the asynchronous copies before reading the buffer on the host
+            torch.cuda.synchronize(self.device)
+        all_query_embeddings = all_query_embeddings.numpy()
+
+        eval_loss = eval_loss.item() / nb_eval_steps
 
         results["eval_loss"] = eval_loss
 
@@ -1934,7 +1961,7 @@ class RetrievalModel:
                 return_doc_dicts=True,
             )
 
-            doc_texts = [doc_dict["passages"] for doc_dict in doc_dicts]
+            doc_texts = list(map(itemgetter("passages"), doc_dicts))
 
             top_k_accuracy_each_query = None
             recall_at_k_each_query = None
@@ -2013,18 +2040,34 @@ class RetrievalModel:
             split=eval_set
         )
 
-        beir_model = DRES(
-            BeirRetrievalModel(
-                self.context_encoder,
-                self.query_encoder,
-                self.context_tokenizer,
-                self.query_tokenizer,
-                self.context_config,
-                self.query_config,
-                self.args,
-            )
+        beir_retrieval_model = BeirRetrievalModel(
+            self.context_encoder,
+            self.query_encoder,
+            self.context_tokenizer,
+            self.query_tokenizer,
+            self.context_config,
+            self.query_config,
+            self.args,
         )
 
+        # The index is rebuilt on every call, as the encoders change during training
+        if self.args.beir_faiss_index is None:
+            beir_model = DRES(beir_retrieval_model)
+        elif self.args.beir_faiss_index == "hnsw":
+            from beir.retrieval.search.dense import HNSWFaissSearch
+
+            beir_model = HNSWFaissSearch(beir_retrieval_model)
+        elif self.args.beir_faiss_index == "flat":
+            from beir.retrieval.search.dense import FlatIPFaissSearch
+
+            beir_model = FlatIPFaissSearch(beir_retrieval_model)
+        else:
+            raise ValueError(
+                "beir_faiss_index must be one of None, 'hnsw' or 'flat'. Got {}".format(
+                    self.args.beir_faiss_index
+                )
+            )
+
         retriever = EvaluateRetrieval(
             beir_model,
             score_function="dot",
@@ -2104,120 +2147,164 @@ class RetrievalModel:
                 self.prediction_passages = self.get_updated_prediction_passages(
                     prediction_passages
                 )
-                self.context_encoder.to(self.device)
                 if self.args.ance_training and is_training:
                     logger.info("Done updating corpus embeddings.")
 
         all_reranking_query_embeddings = None
 
+        # Every row is written by the batching loop below
         if self.args.larger_representations:
             if self.unified_rr:
-                all_query_embeddings = np.zeros(
-                    (len(to_predict), self.query_config.hidden_size)
+                all_query_embeddings = np.empty(
+                    (len(to_predict), self.query_config.hidden_size), dtype=np.float32
                 )
-                all_reranking_query_embeddings = np.zeros(
-                    (len(to_predict), self.query_config.hidden_size)
+                all_reranking_query_embeddings = np.empty(
+                    (len(to_predict), self.query_config.hidden_size), dtype=np.float32
                 )
             else:
-                all_query_embeddings = np.zeros(
+                all_query_embeddings = np.empty(
                     (
                         len(to_predict),
                         self.query_config.hidden_size
                         * (1 + self.args.extra_cls_token_count),
-                    )
+                    ),
+                    dtype=np.float32,
                 )
         else:
-            all_query_embeddings = np.zeros(
+            all_query_embeddings = np.empty(
                 (
                     len(to_predict),
-                    self.query_config.hidden_size
-                    if "projection_dim" not in self.query_config.to_dict()
-                    or not self.query_config.projection_dim
-                    else self.query_config.projection_dim,
-                )
+                    self._embedding_dim,
+                ),
+                dtype=np.float32,
             )
 
         query_model = self.query_encoder
         query_model.to(self.device)
+        query_model.eval()
 
+        # With several GPUs, each one gets its own copy of the query encoder and
+        # encodes its own share of the batches, instead of DataParallel scattering
+        # every batch from and gathering it back to the first GPU
         if self.args.n_gpu > 1:
-            query_model = torch.nn.DataParallel(query_model)
-
-        if self.args.fp16:
-            from torch.cuda import amp
-
-        query_model.eval()
+            devices = [torch.device("cuda", i) for i in range(self.args.n_gpu)]
+            query_model.to(devices[0])
+            query_models = [query_model] + self._get_query_replicas(
+                query_model, devices[1:]
+            )
+        else:
+            devices = [torch.device(self.device)]
+            query_models = [query_model]
+
+        if self.args.torch_compile:
+            # Prediction batches are padded to their longest query, hence dynamic shapes
+            query_models = [
+                torch.compile(model, mode=self.args.torch_compile_mode, dynamic=True)
+                for model in query_models
+            ]
 
-        # Batching
-        for i, batch in tqdm(
-            enumerate(
-                [
-                    to_predict[i : i + self.args.eval_batch_size]
-                    for i in range(0, len(to_predict), self.args.eval_batch_size)
-                ]
-            ),
-            desc="Generating query embeddings",
-            disable=self.args.silent,
-            total=math.ceil(len(to_predict) / self.args.eval_batch_size),
-        ):
+        # Batching. Batches are padded to their longest query rather than to
+        # max_seq_length, and the queries are batched in order of length to keep
+        # that padding small. The embeddings are written back in the original order.
+        if isinstance(to_predict, pd.Series):
+            # Queries are looked up by position below
+            to_predict = to_predict.tolist()
+        query_order = np.argsort([len(query) for query in to_predict], kind="stable")
+        batch_size = self.args.eval_batch_size
+        pin_memory = devices[0].type == "cuda"
+
+        def tokenize_batch(batch_indices):
             query_batch = self.query_tokenizer(
-                batch,
+                [to_predict[j] for j in batch_indices],
                 max_length=self.args.max_seq_length,
-                padding="max_length",
+                padding=True,
                 truncation=True,
                 return_tensors="pt",
             )
+            input_ids = query_batch["input_ids"]
+            attention_mask = query_batch["attention_mask"]
+            if pin_memory:
+                input_ids = input_ids.pin_memory()
+                attention_mask = attention_mask.pin_memory()
+            return batch_indices, input_ids, attention_mask
+
+        def encode_on_device(rank, input_ids, attention_mask):
+            with torch.cuda.device(devices[rank]):
+                return self._encode_query_batch(
+                    query_models[rank], devices[rank], input_ids, attention_mask
+                )
 
-            query_inputs = {
-                "input_ids": query_batch["input_ids"].to(self.device),
-                "attention_mask": query_batch["attention_mask"].to(self.device),
-            }
-
-            with torch.no_grad():
-                if self.args.fp16:
-                    with amp.autocast():
-                        query_outputs = query_model(**query_inputs)
-                        query_outputs = get_output_embeddings(
-                            query_outputs,
-                            concatenate_embeddings=self.args.larger_representations
-                            and self.args.model_type == "custom",
-                            n_cls_tokens=(1 + self.args.extra_cls_token_count),
-                            use_pooler_output=self.args.use_pooler_output,
-                            args=self.args,
-                            return_all_embeddings=self.args.use_autoencoder,
-                            input_mask=query_inputs["attention_mask"],
+        # Views into query_order, produced lazily as the loop consumes them
+        batches = (
+            query_order[i : i + batch_size]
+            for i in range(0, len(to_predict), batch_size)
+        )
+        # The next batch is tokenized in the background while the current one is
+        # encoded, and the outputs are copied back asynchronously. The tokenizer is
+        # only ever used from this one thread, as fast tokenizers can't be shared
+        # between threads.
+        batch_outputs = []
+        with ThreadPoolExecutor(max_workers=1) as tokenizer_executor:
+            tokenized_batches = tqdm(
+                prefetch_map(tokenize_batch, batches, tokenizer_executor),
+                desc="Generating query embeddings",
+                disable=self.args.silent,
+                total=math.ceil(len(to_predict) / batch_size),
+            )
+            if len(devices) == 1:
+                for batch_indices, input_ids, attention_mask in tokenized_batches:
+                    batch_outputs.append(
+                        (
+                            batch_indices,
+                            self._encode_query_batch(
+                                query_models[0], devices[0], input_ids, attention_mask
+                            ),
                         )
-                        if self.args.use_autoencoder:
-                            query_outputs = self.autoencoder_model.encode(query_outputs)
-                else:
-                    query_outputs = query_model(**query_inputs)
-                    query_outputs = get_output_embeddings(
-                        query_outputs,
-                        concatenate_embeddings=self.args.larger_representations
-                        and self.args.model_type == "custom",
-                        n_cls_tokens=(1 + self.args.extra_cls_token_count),
-                        use_pooler_output=self.args.use_pooler_output,
-                        args=self.args,
-                        query_embeddings=True,
-                        input_mask=query_inputs["attention_mask"],
                     )
+            else:
+                # Batches are handed out round-robin so that every GPU gets a similar
+                # mix of query lengths. Each GPU has its own thread, and the CUDA
+                # kernels release the GIL, so the GPUs encode concurrently. At most
+                # two batches per GPU are in flight at a time.
+                device_executors = [ThreadPoolExecutor(max_workers=1) for _ in devices]
+                pending = []
+                try:
+                    for n, (batch_indices, input_ids, attention_mask) in enumerate(
+                        tokenized_batches
+                    ):
+                        rank = n % len(devices)
+                        pending.append(
+                            (
+                                batch_indices,
+                                device_executors[rank].submit(
+                                    encode_on_device, rank, input_ids, attention_mask
+                                ),
+                            )
+                        )
+                        if len(pending) > 2 * len(devices):
+                            batch_indices, future = pending.pop(0)
+                            batch_outputs.append((batch_indices, future.result()))
+                    batch_outputs.extend(
+                        (batch_indices, future.result())
+                        for batch_indices, future in pending
+                    )
+                finally:
+                    for executor in device_executors:
+                        executor.shutdown()
 
+        if pin_memory:
+            # Wait for the asynchronous copies before reading the outputs on the host
+            for device in devices:
+                torch.cuda.synchronize(device)
+
+        for batch_indices, query_outputs in batch_outputs:
             if self.unified_rr:
-                reranking_query_outputs = query_outputs[
+                all_reranking_query_embeddings[batch_indices] = query_outputs[
                     :, query_outputs.size(1) // 2 :
-                ].cpu()
+                ].numpy()
                 query_outputs = query_outputs[:, : query_outputs.size(1) // 2]
-            else:
-                reranking_query_outputs = None
 
-            all_query_embeddings[
-                i * self.args.eval_batch_size : (i + 1) * self.args.eval_batch_size
-            ] = (query_outputs.cpu().detach().numpy())
-
-            if self.unified_rr:
-                all_reranking_query_embeddings[
-                    i * self.args.eval_batch_size : (i + 1) * self.args.eval_batch_size
-                ] = (reranking_query_outputs.cpu().detach().numpy())
+            all_query_embeddings[batch_indices] = query_outputs.numpy()
 
         if passages_only:
             passages = self.retrieve_docs_from_query_embeddings(
@@ -2238,47 +2325,51 @@ class RetrievalModel:
             return doc_ids, scores
         else:
             retrieval_outputs = self.retrieve_docs_from_query_embeddings(
-                all_query_embeddings, self.prediction_passages, retrieve_n_docs
+                all_query_embeddings,
+                self.prediction_passages,
+                retrieve_n_docs,
+                return_rerank_embeddings=self.args.unified_rr,
             )
-            doc_ids, doc_vectors, doc_dicts = retrieval_outputs
+            doc_ids, doc_vectors, doc_dicts = retrieval_outputs[:3]
 
             try:
-                passages = [d["passages"] for d in doc_dicts]
+                passages = list(map(itemgetter("passages"), doc_dicts))
             except KeyError:
-                passages = [d["passage_text"] for d in doc_dicts]
+                passages = list(map(itemgetter("passage_text"), doc_dicts))
 
             if self.args.unified_rr:
-                rerank_similarity = compute_rerank_similarity(
-                    reranking_query_outputs, doc_dicts
+                # (n_queries, n_docs, dim) array of the retrieved rerank embeddings
+                rerank_embeddings = retrieval_outputs[3]
+                rerank_similarity = np.einsum(
+                    "nd,nkd->nk", all_reranking_query_embeddings, rerank_embeddings
                 )
 
                 # Get indices of rerank_similarity sorted by descending order
                 rerank_indices = np.argsort(rerank_similarity, axis=1)[:, ::-1]
 
-                # Sort passages, doc_ids, doc_vectors, doc_dicts by rerank_indices
-                for i, doc_dict in enumerate(doc_dicts):
-                    doc_dict["passages"] = [
-                        doc_dict["passages"][j] for j in rerank_indices[i]
-                    ]
-                    doc_dict["embeddings"] = [
-                        doc_dict["embeddings"][j] for j in rerank_indices[i]
-                    ]
-                    doc_dict["rerank_embeddings"] = [
-                        doc_dict["rerank_embeddings"][j] for j in rerank_indices[i]
-                    ]
-
-                passages = [
-                    [passages[i][j] for j in rerank_indices[i]]
-                    for i in range(len(passages))
-                ]
-                doc_ids = [
-                    [doc_ids[i][j] for j in rerank_indices[i]]
-                    for i in range(len(doc_ids))
-                ]
-                doc_vectors = [
-                    [doc_vectors[i][j] for j in rerank_indices[i]]
-                    for i in range(len(doc_vectors))
-                ]
+                # Sort passages, doc_ids, doc_vectors, doc_dicts by rerank_indices.
+                # Every field is gathered as a whole array, and the doc_dicts are
+                # given views of the reordered arrays.
+                passages_array = np.empty(rerank_indices.shape, dtype=object)
+                passages_array[:] = passages
+                passages_array = np.take_along_axis(
+                    passages_array, rerank_indices, axis=1
+                )
+                rerank_embeddings = np.take_along_axis(
+                    rerank_embeddings, rerank_indices[:, :, None], axis=1
+                )
+                for doc_dict, passages_i, rerank_embeddings_i, indices in zip(
+                    doc_dicts, passages_array, rerank_embeddings, rerank_indices
+                ):
+                    doc_dict["passages"] = passages_i.tolist()
+                    doc_dict["embeddings"] = np.asarray(doc_dict["embeddings"])[indices]
+                    doc_dict["rerank_embeddings"] = rerank_embeddings_i
+
+                passages = passages_array.tolist()
+                doc_ids = np.take_along_axis(doc_ids, rerank_indices, axis=1)
+                doc_vectors = np.take_along_axis(
+                    doc_vectors, rerank_indices[:, :, None], axis=1
+                )
 
             return passages, doc_ids, doc_vectors, doc_dicts
 
@@ -2307,91 +2398,110 @@ class RetrievalModel:
 
         top_k_values = [k for k in top_k_values if k <= args.retrieve_n_docs]
 
-        relevance_list_first_hit = np.zeros((len(gold_passages), args.retrieve_n_docs))
-        relevance_list_all_hits = np.zeros((len(gold_passages), args.retrieve_n_docs))
+        # The relevance matrices only hold 0/1 values
+        relevance_list_first_hit = np.zeros(
+            (len(gold_passages), args.retrieve_n_docs), dtype=np.uint8
+        )
 
+        # Passages are normalized once each, rather than once per comparison. The same
+        # passages are usually retrieved for many queries, so the results are memoized
+        # for the duration of this call. QA evaluation checks whether the answer is
+        # contained in the passage.
+        normalize = lru_cache(maxsize=None)(
+            partial(normalize_passage, remove_spaces=qa_evaluation)
+        )
         if relevant_docs is None:
+            # Only the first match matters here, so the scan stops there and the
+            # first hits of all queries are written with a single scatter
+            hit_rows = []
+            hit_columns = []
             for i, (docs, truth) in enumerate(zip(doc_texts, gold_passages)):
-                for j, d in enumerate(docs):
-                    if qa_evaluation:
-                        if truth.strip().lower().replace(" ", "").translate(
-                            str.maketrans("", "", string.punctuation)
-                        ) in d.strip().lower().replace(" ", "").translate(
-                            str.maketrans("", "", string.punctuation)
-                        ):
-                            relevance_list_first_hit[i, j] = 1
-                            break
-                    else:
-                        if d.strip().lower().translate(
-                            str.maketrans("", "", string.punctuation)
-                        ) == truth.strip().lower().translate(
-                            str.maketrans("", "", string.punctuation)
-                        ):
-                            relevance_list_first_hit[i, j] = 1
-                            break
+                truth = normalize(truth)
+                if qa_evaluation:
+                    matches = (truth in normalize(d) for d in docs)
+                else:
+                    matches = (normalize(d) == truth for d in docs)
+                first_hit = next((j for j, match in enumerate(matches) if match), None)
+                if first_hit is not None:
+                    hit_rows.append(i)
+                    hit_columns.append(first_hit)
+            relevance_list_first_hit[hit_rows, hit_columns] = 1
             relevance_list_all_hits = relevance_list_first_hit
         else:
+            relevance_list_all_hits = np.zeros_like(relevance_list_first_hit)
             total_relevant = [
                 len(relevant_doc_set) for relevant_doc_set in relevant_docs
             ]
             for i, (docs, relevant_doc_set) in enumerate(zip(doc_texts, relevant_docs)):
-                for j, d in enumerate(docs):
-                    for relevant in relevant_doc_set:
-                        if qa_evaluation:
-                            if relevant.strip().lower().replace(" ", "").translate(
-                                str.maketrans("", "", string.punctuation)
-                            ) in d.strip().lower().replace(" ", "").translate(
-                                str.maketrans("", "", string.punctuation)
-                            ):
-                                relevance_list_all_hits[i, j] = 1
-                                if sum(relevance_list_first_hit[i]) == 0:
-                                    relevance_list_first_hit[i, j] = 1
-                                break
-                        else:
-                            if d.strip().lower().translate(
-                                str.maketrans("", "", string.punctuation)
-                            ) == relevant.strip().lower().translate(
-                                str.maketrans("", "", string.punctuation)
-                            ):
-                                relevance_list_all_hits[i, j] = 1
-                                if sum(relevance_list_first_hit[i]) == 0:
-                                    relevance_list_first_hit[i, j] = 1
-                                break
+                relevant_set = {normalize(relevant) for relevant in relevant_doc_set}
+                docs = [normalize(d) for d in docs]
+                if qa_evaluation:
+                    hits = [
+                        any(relevant in d for relevant in relevant_set) for d in docs
+                    ]
+                else:
+                    hits = [d in relevant_set for d in docs]
+                # Whole rows are written at once rather than element by element
+                relevance_list_all_hits[i, : len(hits)] = hits
+
+            # The first hit of each query is its first nonzero column
+            queries_with_hits = np.flatnonzero(relevance_list_all_hits.any(axis=1))
+            relevance_list_first_hit[
+                queries_with_hits,
+                np.argmax(relevance_list_all_hits[queries_with_hits], axis=1),
+            ] = 1
+
+        # The rank of the first hit (past the last column when there is none) is
+        # compared against every cutoff at once, giving an (N, K) table
+        cutoffs = np.asarray(top_k_values)
+        first_hit_rank = np.where(
+            relevance_list_first_hit.any(axis=1),
+            np.argmax(relevance_list_first_hit, axis=1) + 1,
+            relevance_list_first_hit.shape[1] + 1,
+        )
+        top_k_accuracy_table = (first_hit_rank[:, None] <= cutoffs).astype(np.float64)
+        mrr_table = top_k_accuracy_table / first_hit_rank[:, None]
+        if relevant_docs is not None:
+            # A single cumulative sum gives the number of hits within the top k
+            all_hits_at_k = np.cumsum(relevance_list_all_hits, axis=1)
+            total_relevant = np.asarray(total_relevant)
 
-        mrr_each_query_dict = {}
-        mrr = {}
-        for k in top_k_values:
-            mrr_at_k, mrr_matrix_k = mean_reciprocal_rank_at_k(
-                relevance_list_first_hit, k, return_individual_scores=True
+        mrr = dict(zip((f"mrr_at_{k}" for k in top_k_values), mrr_table.mean(axis=0)))
+        mrr_each_query_dict = dict(
+            zip((f"mrr_at_{k}" for k in top_k_values), mrr_table.T.tolist())
+        )
+        top_k_accuracy_dict = dict(
+            zip(
+                (f"top_{k}_accuracy" for k in top_k_values),
+                top_k_accuracy_table.mean(axis=0),
             )
-            mrr[f"mrr_at_{k}"] = mrr_at_k
-            mrr_each_query_dict[f"mrr_at_{k}"] = mrr_matrix_k
-
-        top_k_accuracy_dict = {}
-        top_k_accuracy_each_query_dict = {}
+        )
+        top_k_accuracy_each_query_dict = dict(
+            zip(
+                (f"top_{k}_accuracy" for k in top_k_values),
+                top_k_accuracy_table.T.tolist(),
+            )
+        )
         recall_at_k_dict = {}
         recall_at_k_each_query_dict = {}
 
-        for k in top_k_values:
-            top_k_accuracy_each_query = np.sum(relevance_list_first_hit[:, :k], axis=1)
-            top_k_accuracy_dict[f"top_{k}_accuracy"] = np.mean(
-                top_k_accuracy_each_query
-            )
-            top_k_accuracy_each_query_dict[
-                f"top_{k}_accuracy"
-            ] = top_k_accuracy_each_query.tolist()
-
-            if relevant_docs is not None:
-                recall_at_k, recall_at_k_each_query = get_recall_at_k(
-                    relevance_list_all_hits, total_relevant, k
+        if relevant_docs is not None:
+            for k in top_k_values:
+                recall_at_k_each_query = all_hits_at_k[:, k - 1] / np.minimum(
+                    total_relevant, k
+                )
+                recall_at_k_dict[f"recall_at_{k}"] = np.mean(recall_at_k_each_query)
+                recall_at_k_each_query_dict[f"recall_at_{k}"] = (
+                    recall_at_k_each_query.tolist()
                 )
-                recall_at_k_dict[f"recall_at_{k}"] = recall_at_k
-                recall_at_k_each_query_dict[f"recall_at_{k}"] = recall_at_k_each_query
 
         extra_metrics = {}
         for metric, func in kwargs.items():
             extra_metrics[metric] = func(gold_passages, doc_texts)
 
+        # Returned as float64, like the per-query values above
+        relevance_list_all_hits = relevance_list_all_hits.astype(np.float64)
+
         if relevant_docs is not None:
             return (
                 {**mrr, **top_k_accuracy_dict, **recall_at_k_dict, **extra_metrics},
@@ -2417,14 +2527,23 @@ class RetrievalModel:
         passages_only=False,
         doc_ids_only=False,
         reranking_query_outputs=None,
+        return_rerank_embeddings=False,
     ):
         """
         Retrieves documents from the index using the given query embeddings.
+
+        If return_rerank_embeddings is True, the rerank_embeddings of the retrieved
+        documents are also returned as a single (n_queries, retrieve_n_docs, dim)
+        float32 array.
         """
         args = self.args
         if retrieve_n_docs is None:
             retrieve_n_docs = args.retrieve_n_docs
 
+        # FAISS works on float32. This is a no-op for the embeddings from evaluate()
+        # and predict(), which are already float32, instead of a copy per batch.
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+
         query_embeddings_batched = [
             query_embeddings[i : i + args.retrieval_batch_size]
             for i in range(0, len(query_embeddings), args.retrieval_batch_size)
@@ -2448,15 +2567,15 @@ class RetrievalModel:
                 )
             ):
                 doc_dicts_batch = passage_dataset.get_top_docs(
-                    query_embeddings_retr.astype(np.float32),
+                    query_embeddings_retr,
                     retrieve_n_docs,
                     passages_only=True,
                 )
 
                 try:
-                    passages.extend([d["passages"] for d in doc_dicts_batch])
+                    passages.extend(map(itemgetter("passages"), doc_dicts_batch))
                 except KeyError:
-                    passages.extend([d["passage_text"] for d in doc_dicts_batch])
+                    passages.extend(map(itemgetter("passage_text"), doc_dicts_batch))
 
             return passages
         elif doc_ids_only:
@@ -2471,7 +2590,7 @@ class RetrievalModel:
                 )
             ):
                 ids, scores = passage_dataset.get_top_doc_ids(
-                    query_embeddings_retr.astype(np.float32), retrieve_n_docs
+                    query_embeddings_retr, retrieve_n_docs
                 )
                 doc_ids_batched.extend(ids)
                 scores_batched.extend(scores)
@@ -2480,27 +2599,39 @@ class RetrievalModel:
 
             return doc_ids_batched, reranking_scores
         else:
-            ids_batched = np.zeros((len(query_embeddings), retrieve_n_docs))
+            # Every row is filled below, so these are left uninitialized and use the
+            # FAISS index dtypes (or float16 vectors to halve their memory)
+            if args.retrieval_quantize_embeddings is None:
+                vectors_dtype = np.float32
+            elif args.retrieval_quantize_embeddings == "fp16":
+                vectors_dtype = np.float16
+            else:
+                raise ValueError(
+                    "retrieval_quantize_embeddings must be None or 'fp16'. Got {}".format(
+                        args.retrieval_quantize_embeddings
+                    )
+                )
+            ids_batched = np.empty((len(query_embeddings), retrieve_n_docs), np.int64)
             if self.args.larger_representations:
-                vectors_batched = np.zeros(
+                vectors_batched = np.empty(
                     (
                         len(query_embeddings),
                         retrieve_n_docs,
                         self.query_config.hidden_size
                         * (1 + args.extra_cls_token_count),
-                    )
+                    ),
+                    dtype=vectors_dtype,
                 )
             else:
-                vectors_batched = np.zeros(
+                vectors_batched = np.empty(
                     (
                         len(query_embeddings),
                         retrieve_n_docs,
-                        self.context_config.hidden_size
-                        if "projection_dim" not in self.context_config.to_dict()
-                        or not self.context_config.projection_dim
-                        else self.context_config.projection_dim,
-                    )
+                        self._context_embedding_dim,
+                    ),
+                    dtype=vectors_dtype,
                 )
+            rerank_embeddings_batched = None
             doc_dicts = []
 
             for i, query_embeddings_retr in enumerate(
@@ -2511,7 +2642,7 @@ class RetrievalModel:
                 )
             ):
                 ids, vectors, doc_dicts_batch = passage_dataset.get_top_docs(
-                    query_embeddings_retr.astype(np.float32), retrieve_n_docs
+                    query_embeddings_retr, retrieve_n_docs
                 )
                 ids_batched[
                     i * args.retrieval_batch_size : (i * args.retrieval_batch_size)
@@ -2522,12 +2653,36 @@ class RetrievalModel:
                     + len(ids)
                 ] = vectors
 
+                if return_rerank_embeddings:
+                    rerank_embeddings = np.asarray(
+                        [doc["rerank_embeddings"] for doc in doc_dicts_batch],
+                        dtype=np.float32,
+                    )
+                    if rerank_embeddings_batched is None:
+                        # The reranking dimension is only known from the index
+                        rerank_embeddings_batched = np.empty(
+                            (len(query_embeddings), *rerank_embeddings.shape[1:]),
+                            dtype=np.float32,
+                        )
+                    rerank_embeddings_batched[
+                        i * args.retrieval_batch_size : (i * args.retrieval_batch_size)
+                        + len(ids)
+                    ] = rerank_embeddings
+
                 if return_doc_dicts:
                     doc_dicts.extend(doc_dicts_batch)
 
             if not return_doc_dicts:
                 doc_dicts = None
 
+            if return_rerank_embeddings:
+                return (
+                    ids_batched,
+                    vectors_batched,
+                    doc_dicts,
+                    rerank_embeddings_batched,
+                )
+
             return ids_batched, vectors_batched, doc_dicts
 
     def get_hard_negatives(
@@ -2565,16 +2720,21 @@ class RetrievalModel:
         retrieve_n_docs=None,
         write_to_disk=True,
         hard_negatives_save_file_path=None,
+        return_df=True,
     ):
+        """
+        Retrieves retrieve_n_docs hard negatives for each query and optionally writes them to a TSV file.
+
+        If return_df is False, the rows are written straight to the TSV file without building
+        a DataFrame (halving the peak memory use for large query sets) and None is returned.
+        """  # noqa: ignore flake8"
         hard_negatives = self.get_hard_negatives(
             queries,
             passage_dataset=passage_dataset,
             retrieve_n_docs=retrieve_n_docs,
         )
 
-        # Build hard negative df from list of lists
         column_names = [f"hard_negatives_{i}" for i in range(retrieve_n_docs)]
-        hard_negative_df = pd.DataFrame(hard_negatives, columns=column_names)
 
         if write_to_disk:
             if hard_negatives_save_file_path is None:
@@ -2582,6 +2742,19 @@ class RetrievalModel:
                 hard_negatives_save_file_path = os.path.join(
                     self.args.output_dir, "hard_negatives.tsv"
                 )
+
+        if not return_df:
+            if write_to_disk:
+                with open(hard_negatives_save_file_path, "w", newline="") as f:
+                    writer = csv.writer(f, delimiter="\t")
+                    writer.writerow(column_names)
+                    writer.writerows(hard_negatives)
+            return None
+
+        # Build hard negative df from list of lists
+        hard_negative_df = pd.DataFrame(hard_negatives, columns=column_names)
+
+        if write_to_disk:
             hard_negative_df.to_csv(
                 hard_negatives_save_file_path,
                 index=False,
@@ -2848,6 +3021,74 @@ class RetrievalModel:
 
         return scheduler
 
+    def _get_query_replicas(self, query_model, devices):
+        """
+        Returns copies of query_model on each of devices. The copies are made once and
+        reused by later calls, with only their weights refreshed from query_model.
+        """
+        if (
+            self._query_replicas is None
+            or self._query_replicas[0] is not query_model
+            or self._query_replicas[1] != devices
+        ):
+            self._query_replicas = (
+                query_model,
+                devices,
+                [copy.deepcopy(query_model).to(device) for device in devices],
+            )
+        else:
+            # The weights may have been updated (e.g. by training) since the copies
+            # were made. Loading them in place is a device-to-device copy.
+            state_dict = query_model.state_dict()
+            for replica in self._query_replicas[2]:
+                replica.load_state_dict(state_dict)
+
+        return self._query_replicas[2]
+
+    def _encode_query_batch(self, query_model, device, input_ids, attention_mask):
+        """
+        Encodes a tokenized batch of queries with query_model on device. Returns the
+        float32 embeddings as a CPU tensor, filled asynchronously when the inputs are
+        pinned.
+        """
+        query_inputs = {
+            "input_ids": input_ids.to(device, non_blocking=True),
+            "attention_mask": attention_mask.to(device, non_blocking=True),
+        }
+
+        with torch.inference_mode():
+            if self.args.fp16:
+                with self._autocast():
+                    query_outputs = query_model(**query_inputs)
+                    query_outputs = get_output_embeddings(
+                        query_outputs,
+                        concatenate_embeddings=self._concatenate_embeddings,
+                        n_cls_tokens=self._n_cls_tokens,
+                        use_pooler_output=self.args.use_pooler_output,
+                        args=self.args,
+                        return_all_embeddings=self.args.use_autoencoder,
+                        input_mask=query_inputs["attention_mask"],
+                    )
+                    if self.args.use_autoencoder:
+                        # The autoencoder is only kept on the main device
+                        query_outputs = self.autoencoder_model.encode(
+                            query_outputs.to(self.device)
+                        )
+            else:
+                query_outputs = query_model(**query_inputs)
+                query_outputs = get_output_embeddings(
+                    query_outputs,
+                    concatenate_embeddings=self._concatenate_embeddings,
+                    n_cls_tokens=self._n_cls_tokens,
+                    use_pooler_output=self.args.use_pooler_output,
+                    args=self.args,
+                    query_embeddings=True,
+                    input_mask=query_inputs["attention_mask"],
+                )
+
+        # Cast to float32 on the device, so the host buffers need no conversion
+        return query_outputs.float().to("cpu", non_blocking=True)
+
     def get_updated_prediction_passages(self, prediction_passages):
         """
         Update the model passage dataset with a new passage dataset.
@@ -2867,6 +3108,161 @@ class RetrievalModel:
 
         return prediction_passages
 
+    def _similarity_score(self, query_outputs, context_outputs):
+        """
+        In-batch dot product similarity between every query and every context. With bf16,
+        the encoders run in bfloat16 but the embeddings are upcast and the similarity is
+        computed in float32, outside autocast, to keep the scores for the loss precise.
+        """
+        if self.args.bf16:
+            with torch.autocast(
+                device_type=torch.device(self.device).type, enabled=False
+            ):
+                return torch.matmul(query_outputs.float(), context_outputs.float().t())
+        return torch.matmul(query_outputs, context_outputs.t())
+
+    def _get_qat_loss(self, query_outputs, context_outputs, labels):
+        """
+        Quantization-aware training loss. The in-batch NLL loss is computed again on fake
+        quantized embeddings for each of args.qat_precisions, weighted by args.qat_weights,
+        so that the embeddings stay useful when the index is stored in that precision.
+        """
+        qat_weights = self.args.qat_weights or [1.0] * len(self.args.qat_precisions)
+        if len(qat_weights) != len(self.args.qat_precisions):
+            raise ValueError(
+                "qat_weights must have one weight for each of qat_precisions. Got {} and {}".format(
+                    qat_weights, self.args.qat_precisions
+                )
+            )
+
+        qat_loss = 0.0
+        for precision, weight in zip(self.args.qat_precisions, qat_weights):
+            similarity_score = self._similarity_score(
+                fake_quantize(query_outputs, precision),
+                fake_quantize(context_outputs, precision),
+            )
+            qat_loss = qat_loss + weight * torch.nn.functional.cross_entropy(
+                similarity_score, labels
+            )
+
+        return qat_loss
+
+    def _get_triplets(
+        self, query_outputs, positive_context_outputs, negative_context_outputs
+    ):
+        """
+        Selects the (anchor, positive, negative) triplets for the triplet loss according to
+        args.triplet_variant. negative_context_outputs holds the hard negatives of every
+        query, one block of batch_size rows per hard negative.
+
+        - "all": One triplet per hard negative of each query.
+        - "hard": One triplet per query, with its closest hard negative.
+        - "mean": One triplet per query, with the mean of its hard negatives.
+        """
+        negative_context_outputs = negative_context_outputs.view(
+            -1, *query_outputs.shape
+        )
+
+        if self.args.triplet_variant == "all":
+            n_negatives = negative_context_outputs.size(0)
+            if n_negatives == 1:
+                return (
+                    query_outputs,
+                    positive_context_outputs,
+                    negative_context_outputs[0],
+                )
+            return (
+                query_outputs.repeat(n_negatives, 1),
+                positive_context_outputs.repeat(n_negatives, 1),
+                negative_context_outputs.flatten(0, 1),
+            )
+        elif self.args.triplet_variant == "hard":
+            with torch.no_grad():
+                hardest = torch.linalg.vector_norm(
+                    query_outputs - negative_context_outputs, dim=-1
+                ).argmin(dim=0)
+            return (
+                query_outputs,
+                positive_context_outputs,
+                negative_context_outputs[
+                    hardest, torch.arange(len(hardest), device=hardest.device)
+                ],
+            )
+        elif self.args.triplet_variant == "mean":
+            return (
+                query_outputs,
+                positive_context_outputs,
+                negative_context_outputs.mean(dim=0),
+            )
+        else:
+            raise ValueError(
+                "triplet_variant must be one of 'all', 'hard' or 'mean'. Got {}".format(
+                    self.args.triplet_variant
+                )
+            )
+
+    def _train_step(
+        self,
+        context_model,
+        query_model,
+        context_inputs,
+        query_inputs,
+        labels,
+        margins=None,
+        true_p_scores=None,
+        true_n_scores=None,
+    ):
+        """
+        Runs the forward pass and loss calculation for a single training step.
+
+        Kept separate from the training loop so that it can be wrapped with torch.compile().
+        """
+        with self._autocast():
+            return self._calculate_loss(
+                context_model,
+                query_model,
+                context_inputs,
+                query_inputs,
+                labels,
+                margins=margins,
+                true_p_scores=true_p_scores,
+                true_n_scores=true_n_scores,
+            )
+
+    def _encode_on_streams(
+        self, context_model, query_model, context_inputs, query_inputs
+    ):
+        """
+        Runs the context and query encoder forward passes concurrently on two side CUDA streams.
+        The current stream waits on both before the outputs are used, and autograd replays the
+        backward ops on the same streams.
+        """
+        device = query_inputs["input_ids"].device
+        if self._encoder_streams is None:
+            self._encoder_streams = (
+                torch.cuda.Stream(device=device),
+                torch.cuda.Stream(device=device),
+            )
+        context_stream, query_stream = self._encoder_streams
+        current_stream = torch.cuda.current_stream(device)
+
+        context_stream.wait_stream(current_stream)
+        query_stream.wait_stream(current_stream)
+        # The inputs were allocated on the current stream and the outputs are allocated
+        # on the side streams, so each is recorded on the stream it is also used on
+        record_stream(context_inputs, context_stream)
+        record_stream(query_inputs, query_stream)
+        with torch.cuda.stream(context_stream):
+            context_outputs = context_model(**context_inputs)
+        with torch.cuda.stream(query_stream):
+            query_outputs = query_model(**query_inputs)
+        current_stream.wait_stream(context_stream)
+        current_stream.wait_stream(query_stream)
+        record_stream(context_outputs, current_stream)
+        record_stream(query_outputs, current_stream)
+
+        return context_outputs, query_outputs
+
     def _calculate_loss(
         self,
         context_model,
@@ -2897,26 +3293,49 @@ class RetrievalModel:
         with torch.no_grad() if not (
             self.args.train_context_encoder or self.args.train_query_encoder
         ) else nullcontext():
-            if self.args.external_embeddings:
+            use_cached_context = "cached_embeddings" in context_inputs
+            if use_cached_context:
+                # The context encoder is frozen and its embeddings were computed before training
+                context_outputs = context_inputs["cached_embeddings"]
+                query_outputs = query_model(**query_inputs)
+            elif self.args.external_embeddings:
                 context_outputs = context_inputs["external_embeddings"]
+                query_outputs = query_model(**query_inputs)
+            elif (
+                self.args.overlap_encoder_streams and query_inputs["input_ids"].is_cuda
+            ):
+                context_outputs, query_outputs = self._encode_on_streams(
+                    context_model, query_model, context_inputs, query_inputs
+                )
             else:
-                context_outputs = context_model(**context_inputs)
-            query_outputs = query_model(**query_inputs)
-
-            context_outputs = get_output_embeddings(
-                context_outputs,
-                concatenate_embeddings=self.args.larger_representations
-                and self.args.model_type == "custom",
-                n_cls_tokens=(1 + self.args.extra_cls_token_count),
-                use_pooler_output=self.args.use_pooler_output,
-                args=self.args,
-                return_all_embeddings=self.args.use_autoencoder,
-            )
+                if (
+                    self.args.offload_context_activations
+                    and context_inputs["input_ids"].is_cuda
+                ):
+                    offload_context = torch.autograd.graph.save_on_cpu(pin_memory=True)
+                else:
+                    offload_context = nullcontext()
+                with offload_context:
+                    context_outputs = context_model(**context_inputs)
+                query_outputs = query_model(**query_inputs)
+
+            if not use_cached_context:
+                context_outputs = get_output_embeddings(
+                    context_outputs,
+                    concatenate_embeddings=self._concatenate_embeddings,
+                    n_cls_tokens=self._n_cls_tokens,
+                    use_pooler_output=self.args.use_pooler_output,
+                    args=self.args,
+                    return_all_embeddings=self.args.use_autoencoder,
+                )
+                if self.args.quantize_context_encoder:
+                    # A bf16 context encoder would otherwise give embeddings of a different
+                    # dtype than the query encoder's when autocast is off
+                    context_outputs = context_outputs.float()
             query_outputs = get_output_embeddings(
                 query_outputs,
-                concatenate_embeddings=self.args.larger_representations
-                and self.args.model_type == "custom",
-                n_cls_tokens=(1 + self.args.extra_cls_token_count),
+                concatenate_embeddings=self._concatenate_embeddings,
+                n_cls_tokens=self._n_cls_tokens,
                 use_pooler_output=self.args.use_pooler_output,
                 args=self.args,
                 query_embeddings=True,
@@ -2925,43 +3344,46 @@ class RetrievalModel:
             if self.args.multi_vector_query:
                 query_outputs = query_outputs[0]
 
-            context_outputs = torch.nn.functional.dropout(
-                context_outputs, p=self.args.output_dropout
-            )
-            query_outputs = torch.nn.functional.dropout(
-                query_outputs, p=self.args.output_dropout
-            )
+            # Skipped entirely (rather than run as a copy) when it is disabled, and only
+            # applied in training, like the dropout inside the encoders
+            if self.args.output_dropout > 0 and context_model.training:
+                context_outputs = torch.nn.functional.dropout(
+                    context_outputs, p=self.args.output_dropout
+                )
+            if self.args.output_dropout > 0 and query_model.training:
+                query_outputs = torch.nn.functional.dropout(
+                    query_outputs, p=self.args.output_dropout
+                )
 
         if self.args.include_triplet_loss:
-            nll_criterion = torch.nn.NLLLoss(reduction="mean")
-            triplet_criterion = torch.nn.TripletMarginLoss(
-                margin=self.args.triplet_margin, reduction="mean"
-            )
             positive_context_outputs = context_outputs[: query_outputs.size(0)]
             negative_context_outputs = context_outputs[query_outputs.size(0) :]
             nll_labels = labels
 
             if self.args.include_hard_negatives_for_triplets_only:
-                similarity_score = torch.matmul(
-                    query_outputs, positive_context_outputs.t()
+                similarity_score = self._similarity_score(
+                    query_outputs, positive_context_outputs
                 )
-                softmax_score = torch.nn.functional.log_softmax(
-                    similarity_score, dim=-1
-                )
-                nll_loss = nll_criterion(softmax_score, nll_labels)
             else:
-                similarity_score = torch.matmul(query_outputs, context_outputs.t())
-                softmax_score = torch.nn.functional.log_softmax(
-                    similarity_score, dim=-1
+                similarity_score = self._similarity_score(
+                    query_outputs, context_outputs
                 )
-                nll_loss = nll_criterion(softmax_score, nll_labels)
+            nll_loss = torch.nn.functional.cross_entropy(similarity_score, nll_labels)
 
             if self.context_encoder.training:
-                triplet_loss = triplet_criterion(
+                triplets = self._get_triplets(
                     query_outputs,
                     positive_context_outputs,
                     negative_context_outputs,
                 )
+                if self.args.fused_triplet_loss:
+                    triplet_loss = fused_triplet_margin_loss(
+                        *triplets, margin=self.args.triplet_margin
+                    )
+                else:
+                    triplet_loss = torch.nn.functional.triplet_margin_loss(
+                        *triplets, margin=self.args.triplet_margin, reduction="mean"
+                    )
                 loss = (
                     self.args.nll_lambda * nll_loss
                     + self.args.triplet_lambda * triplet_loss
@@ -2970,23 +3392,26 @@ class RetrievalModel:
                 loss = nll_loss
         else:
             if self.args.skip_hard_negatives_for_nll:
-                similarity_score = torch.matmul(
+                similarity_score = self._similarity_score(
                     query_outputs,
-                    context_outputs[: context_outputs.size(0) // 2, :].t(),
+                    context_outputs[: context_outputs.size(0) // 2, :],
                 )
             else:
-                similarity_score = torch.matmul(query_outputs, context_outputs.t())
-            softmax_score = torch.nn.functional.log_softmax(similarity_score, dim=-1)
+                similarity_score = self._similarity_score(
+                    query_outputs, context_outputs
+                )
 
             if self.args.include_bce_loss and self.context_encoder.training:
-                bce_criterion = torch.nn.BCEWithLogitsLoss()
-                nll_criterion = torch.nn.NLLLoss(reduction="mean")
                 bce_labels, nll_labels = labels
 
-                bce_loss = bce_criterion(similarity_score, bce_labels)
+                bce_loss = torch.nn.functional.binary_cross_entropy_with_logits(
+                    similarity_score, bce_labels
+                )
 
                 if self.args.include_nll_loss:
-                    nll_loss = nll_criterion(softmax_score, nll_labels)
+                    nll_loss = torch.nn.functional.cross_entropy(
+                        similarity_score, nll_labels
+                    )
                     loss = bce_loss + nll_loss
                 else:
                     loss = bce_loss
@@ -3007,7 +3432,6 @@ class RetrievalModel:
                     label_scores,
                 ) = self._get_loss(
                     similarity_score,
-                    softmax_score,
                     labels,
                     query_outputs=query_outputs,
                     context_outputs=context_outputs,
@@ -3016,12 +3440,21 @@ class RetrievalModel:
                     true_n_scores=true_n_scores,
                 )
 
+        if self.args.qat_precisions and (
+            context_model.training or query_model.training
+        ):
+            loss = loss + self._get_qat_loss(
+                query_outputs,
+                context_outputs[: similarity_score.size(1)],
+                nll_labels,
+            )
+
         (
             correct_predictions_count,
             correct_predictions_percentage,
             teacher_correct_predictions_percentage,
         ) = self._get_running_stats(
-            softmax_score,
+            similarity_score,
             nll_labels,
             label_scores,
         )
@@ -3183,7 +3616,6 @@ class RetrievalModel:
     def _get_loss(
         self,
         similarity_score,
-        softmax_score,
         labels,
         label_scores=None,
         query_outputs=None,
@@ -3193,33 +3625,28 @@ class RetrievalModel:
         true_n_scores=None,
     ):
         if self.args.mse_loss:
-            mse_criterion = torch.nn.MSELoss()
-
             label_scores = label_scores.reshape(similarity_score.shape)
-            mse_loss = mse_criterion(
+            mse_loss = torch.nn.functional.mse_loss(
                 similarity_score,
                 label_scores,
             )
         if self.args.include_nll_loss:
-            criterion = torch.nn.NLLLoss(reduction="mean")
-            nll_loss = criterion(softmax_score, labels)
-            nll_labels = labels
+            # cross_entropy fuses the log_softmax and NLL loss over the similarity scores
+            nll_loss = torch.nn.functional.cross_entropy(similarity_score, labels)
         if self.args.include_margin_mse_loss:
-            mmse_criterion = MarginMSELoss()
             half = context_outputs.size(0) // 2
             hn_outputs = context_outputs[half:, :]
             positive_outputs = context_outputs[:half, :]
 
-            mmse_loss = mmse_criterion(
+            mmse_loss = self._margin_mse_criterion(
                 query_outputs, positive_outputs, hn_outputs, margins
             )
         if self.args.include_kl_div_loss:
-            kl_criterion = KLDivLossForTriplets()
             half = context_outputs.size(0) // 2
             hn_outputs = context_outputs[half:, :]
             positive_outputs = context_outputs[:half, :]
 
-            kl_div_loss = kl_criterion(
+            kl_div_loss = self._kl_div_criterion(
                 query_outputs,
                 positive_outputs,
                 hn_outputs,
@@ -3239,6 +3666,7 @@ class RetrievalModel:
                 "One of include_nll_loss, mse_loss, include_margin_mse_loss or reranking_kl_div_loss must be True."
             )
 
+        # Already the device tensor from _get_inputs_dict, compared as is for accuracy
         nll_labels = labels
 
         if self.args.include_nll_loss:
@@ -3266,33 +3694,33 @@ class RetrievalModel:
         else:
             loss = nll_loss
 
-        nll_loss = nll_loss.item() if self.args.include_nll_loss else None
+        # Returned as a tensor so that it is only synced with the host when it is logged
+        nll_loss = nll_loss.detach() if self.args.include_nll_loss else None
         return loss, nll_loss, nll_labels, label_scores
 
     def _get_running_stats(
         self,
-        softmax_score,
+        similarity_score,
         nll_labels,
         label_scores,
     ):
-        max_score, max_idxs = torch.max(softmax_score, 1)
-        correct_predictions_count = (
-            (max_idxs == nll_labels.clone().detach()).sum().cpu().numpy().item()
-        )
+        # log_softmax is monotonic, so the argmax of the raw similarity scores is the same
+        max_idxs = similarity_score.argmax(dim=1)
+        # The counts stay on the device, so this doesn't sync every step. They are only
+        # copied to the host when they are logged.
+        correct_predictions_count = (max_idxs == nll_labels).sum()
         correct_predictions_percentage = (
             correct_predictions_count / len(nll_labels)
         ) * 100
 
-        if self.args.reranking_kl_div_loss or self.args.mse_loss:
-            teacher_softmax_score = torch.nn.functional.softmax(label_scores, dim=-1)
-            teacher_max_score, teacher_max_idxs = torch.max(teacher_softmax_score, 1)
-            teacher_correct_predictions_count = (
-                (teacher_max_idxs == nll_labels.clone().detach())
-                .sum()
-                .cpu()
-                .numpy()
-                .item()
-            )
+        # The teacher is only used in training, so there are no teacher scores when
+        # evaluating even if a teacher loss is configured
+        if (
+            self.args.reranking_kl_div_loss or self.args.mse_loss
+        ) and label_scores is not None:
+            # Likewise for the teacher scores, without materializing their softmax
+            teacher_max_idxs = label_scores.argmax(dim=1)
+            teacher_correct_predictions_count = (teacher_max_idxs == nll_labels).sum()
             teacher_correct_predictions_percentage = (
                 teacher_correct_predictions_count / len(nll_labels)
             ) * 100
@@ -3305,18 +3733,118 @@ class RetrievalModel:
             teacher_correct_predictions_percentage,
         )
 
+    def _cache_context_embeddings(self, train_dataset, context_model):
+        """
+        Embeds every training passage and hard negative once with the frozen context encoder.
+        The embeddings are added to train_dataset as extra columns so that the context encoder
+        forward pass can be skipped in every training step.
+        """
+        if self.args.hard_negatives:
+            if self.args.n_hard_negatives == 1:
+                column_pairs = [
+                    ("context_ids", "context_mask"),
+                    ("hard_negative_ids", "hard_negatives_mask"),
+                ]
+            else:
+                column_pairs = [("context_ids", "context_mask")] + [
+                    (f"hard_negative_{i}_ids", f"hard_negative_{i}_mask")
+                    for i in range(self.args.n_hard_negatives)
+                ]
+        else:
+            column_pairs = [("context_ids", "context_mask")]
+
+        def embed_batch(batch):
+            embeddings = {}
+            with torch.no_grad(), self._autocast():
+                for ids_column, mask_column in column_pairs:
+                    input_mask = batch[mask_column].to(self.device)
+                    outputs = context_model(
+                        input_ids=batch[ids_column].to(self.device),
+                        attention_mask=input_mask,
+                    )
+                    outputs = get_output_embeddings(
+                        outputs,
+                        concatenate_embeddings=self._concatenate_embeddings,
+                        n_cls_tokens=self._n_cls_tokens,
+                        use_pooler_output=self.args.use_pooler_output,
+                        args=self.args,
+                        input_mask=input_mask,
+                    )
+                    embeddings[f"cached_{ids_column}_embeddings"] = (
+                        outputs.float().cpu().numpy()
+                    )
+            return embeddings
+
+        logger.info(" Caching context embeddings for the frozen context encoder")
+        columns = train_dataset.format["columns"]
+        train_dataset = train_dataset.map(
+            embed_batch, batched=True, batch_size=self.args.embed_batch_size
+        )
+
+        self._cached_context_columns = [
+            f"cached_{ids_column}_embeddings" for ids_column, _ in column_pairs
+        ]
+        train_dataset.set_format(
+            type="pt", columns=columns + self._cached_context_columns
+        )
+
+        return train_dataset
+
+    def _get_train_sampler(self, train_dataset):
+        if self.args.length_bucketing and isinstance(train_dataset, HFDataset):
+            return LengthBucketSampler(
+                get_sequence_lengths(train_dataset),
+                self.args.train_batch_size,
+                n_buckets=self.args.length_bucketing_n_buckets,
+            )
+        return RandomSampler(train_dataset)
+
+    def _get_train_dataloader(self, train_dataset, train_sampler):
+        """
+        Builds the training DataLoader. Batches are pinned when training on a GPU so that the
+        host-to-device copies in _get_inputs_dict can be issued with non_blocking=True.
+        """
+        num_workers = self.args.dataloader_num_workers
+        if isinstance(train_dataset, HFDataset):
+            # Fetch each batch with a single columnar take from the Arrow table, which returns
+            # already stacked tensors, instead of collating per-example dicts
+            if not isinstance(train_sampler, LengthBucketSampler):
+                train_sampler = BatchSampler(
+                    train_sampler, self.args.train_batch_size, drop_last=False
+                )
+            sampler_kwargs = {"sampler": train_sampler, "batch_size": None}
+        else:
+            sampler_kwargs = {
+                "sampler": train_sampler,
+                "batch_size": self.args.train_batch_size,
+            }
+        return DataLoader(
+            train_dataset,
+            **sampler_kwargs,
+            num_workers=num_workers,
+            pin_memory=torch.device(self.device).type == "cuda",
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4 if num_workers > 0 else None,
+        )
+
     def _get_inputs_dict(self, batch, evaluate=False):
         device = self.device
 
-        labels = [i for i in range(len(batch["context_ids"]))]
-        labels = torch.tensor(labels, dtype=torch.long).to(device)
+        # In-batch negatives: the gold passage for query i is context i. The labels are
+        # sliced from a cached arange, which only grows for a larger batch.
+        batch_size = len(batch["context_ids"])
+        arange_labels = self._arange_labels.get(device)
+        if arange_labels is None or len(arange_labels) < batch_size:
+            arange_labels = torch.arange(batch_size, dtype=torch.long, device=device)
+            self._arange_labels[device] = arange_labels
+        labels = arange_labels[:batch_size]
         margins = None
         true_p_scores = None
         true_n_scores = None
 
         if not evaluate:
             # Training
-            # labels = labels.to(device)
+            # labels = labels.to(device, non_blocking=True)
             if self.args.hard_negatives:
                 if self.args.n_hard_negatives == 1:
                     context_ids = torch.cat(
@@ -3356,20 +3884,26 @@ class RetrievalModel:
                         dim=0,
                     )
                 if self.args.include_margin_mse_loss:
-                    margins = batch["margin"].to(device)
+                    margins = batch["margin"].to(device, non_blocking=True)
 
                 if self.args.include_kl_div_loss:
-                    true_p_scores = batch["true_p_scores"].to(device)
-                    true_n_scores = batch["true_n_scores"].to(device)
+                    true_p_scores = batch["true_p_scores"].to(device, non_blocking=True)
+                    true_n_scores = batch["true_n_scores"].to(device, non_blocking=True)
             else:
                 context_ids = batch["context_ids"]
                 context_masks = batch["context_mask"]
 
+            query_ids = batch["query_ids"]
+            query_masks = batch["query_mask"]
+            if self.args.length_bucketing:
+                context_ids, context_masks = trim_padding(context_ids, context_masks)
+                query_ids, query_masks = trim_padding(query_ids, query_masks)
+
             if self.args.external_embeddings:
-                external_embeddings = batch["embeddings"].to(device)
+                external_embeddings = batch["embeddings"].to(device, non_blocking=True)
                 if self.args.hard_negatives:
                     hard_negative_embeddings = batch["hard_negative_embeddings"].to(
-                        device
+                        device, non_blocking=True
                     )
                     external_embeddings = torch.cat(
                         [external_embeddings, hard_negative_embeddings], dim=0
@@ -3379,45 +3913,56 @@ class RetrievalModel:
                 }
 
             context_input = {
-                "input_ids": context_ids.to(device),
-                "attention_mask": context_masks.to(device),
+                "input_ids": context_ids.to(device, non_blocking=True),
+                "attention_mask": context_masks.to(device, non_blocking=True),
             }
+            if self._cached_context_columns is not None:
+                context_input["cached_embeddings"] = torch.cat(
+                    [batch[column] for column in self._cached_context_columns], dim=0
+                ).to(device, non_blocking=True)
             query_input = {
-                "input_ids": batch["query_ids"].to(device),
-                "attention_mask": batch["query_mask"].to(device),
+                "input_ids": query_ids.to(device, non_blocking=True),
+                "attention_mask": query_masks.to(device, non_blocking=True),
             }
         else:
             # Evaluation
-            shuffled_indices = torch.randperm(len(labels))
+            # The pinned batch is copied as is and shuffled on the device, since indexing
+            # it on the host would give unpinned tensors and blocking copies
+            shuffled_indices = torch.randperm(len(labels), device=device)
 
-            labels = labels[shuffled_indices].to(device)
+            # Position j holds context shuffled_indices[j], so the gold passage of query i
+            # is at the inverse permutation
+            labels = torch.argsort(shuffled_indices)
 
+            context_ids = batch["context_ids"].to(device, non_blocking=True)[
+                shuffled_indices
+            ]
+            context_masks = batch["context_mask"].to(device, non_blocking=True)[
+                shuffled_indices
+            ]
             if self.args.hard_negatives and self.args.hard_negatives_in_eval:
                 context_ids = torch.cat(
                     [
-                        batch["context_ids"][shuffled_indices],
-                        batch["hard_negative_ids"],
+                        context_ids,
+                        batch["hard_negative_ids"].to(device, non_blocking=True),
                     ],
                     dim=0,
                 )
                 context_masks = torch.cat(
                     [
-                        batch["context_mask"][shuffled_indices],
-                        batch["hard_negatives_mask"],
+                        context_masks,
+                        batch["hard_negatives_mask"].to(device, non_blocking=True),
                     ],
                     dim=0,
                 )
-            else:
-                context_ids = batch["context_ids"][shuffled_indices]
-                context_masks = batch["context_mask"][shuffled_indices]
 
             context_input = {
-                "input_ids": context_ids.to(device),
-                "attention_mask": context_masks.to(device),
+                "input_ids": context_ids,
+                "attention_mask": context_masks,
             }
             query_input = {
-                "input_ids": batch["query_ids"].to(device),
-                "attention_mask": batch["query_mask"].to(device),
+                "input_ids": batch["query_ids"].to(device, non_blocking=True),
+                "attention_mask": batch["query_mask"].to(device, non_blocking=True),
             }
 
         if (
@@ -3425,10 +3970,28 @@ class RetrievalModel:
             and "labels" in batch.column_names
             and self.args.include_bce_loss
         ):
-            labels = batch["labels"].to(device), labels  # BCELabels, NLLLabels
+            # BCELabels, NLLLabels
+            labels = batch["labels"].to(device, non_blocking=True), labels
 
         return context_input, query_input, labels, margins, true_p_scores, true_n_scores
 
+    def _write_training_progress_row(self, training_progress_scores):
+        """
+        Appends the latest row of training_progress_scores to training_progress_scores.csv instead
+        of rewriting the whole file. The file is recreated with a header for the first row.
+        """
+        columns = list(training_progress_scores.keys())
+        first_row = len(training_progress_scores["global_step"]) == 1
+        with open(
+            os.path.join(self.args.output_dir, "training_progress_scores.csv"),
+            "w" if first_row else "a",
+            newline="",
+        ) as f:
+            writer = csv.writer(f)
+            if first_row:
+                writer.writerow(columns)
+            writer.writerow([training_progress_scores[key][-1] for key in columns])
+
     def _create_training_progress_scores(
         self, calculate_recall=False, top_k_values=None, **kwargs
     ):
@@ -3492,6 +4055,80 @@ class RetrievalModel:
 
         return training_progress_scores
 
+    def _update_best_and_maybe_stop(
+        self,
+        results,
+        best_eval_metric,
+        early_stopping_counter,
+        context_model,
+        query_model,
+        optimizer,
+        scheduler,
+        consider_epochs=False,
+        verbose=True,
+    ):
+        """
+        Saves the best model on improvement and updates the early stopping counter.
+
+        consider_epochs should be True for the evaluations done at the end of an epoch, which
+        only count towards early stopping when early_stopping_consider_epochs is set.
+
+        Returns:
+            best_eval_metric: The updated best value of the early stopping metric
+            early_stopping_counter: The updated number of evaluations without improvement
+            stop_training: True if the early stopping patience has been reached
+        """
+        args = self.args
+
+        def save_best_model():
+            if args.save_best_model:
+                self.save_model(
+                    args.best_model_dir,
+                    optimizer,
+                    scheduler,
+                    context_model=context_model,
+                    query_model=query_model,
+                    results=results,
+                )
+
+        if not best_eval_metric:
+            best_eval_metric = results[args.early_stopping_metric]
+            save_best_model()
+
+        if best_eval_metric and args.early_stopping_metric_minimize:
+            improved = (
+                results[args.early_stopping_metric] - best_eval_metric
+                < args.early_stopping_delta
+            )
+        else:
+            improved = (
+                results[args.early_stopping_metric] - best_eval_metric
+                > args.early_stopping_delta
+            )
+
+        if improved:
+            best_eval_metric = results[args.early_stopping_metric]
+            save_best_model()
+            return best_eval_metric, 0, False
+
+        if not args.use_early_stopping or (
+            consider_epochs and not args.early_stopping_consider_epochs
+        ):
+            return best_eval_metric, early_stopping_counter, False
+
+        if early_stopping_counter < args.early_stopping_patience:
+            early_stopping_counter += 1
+            if verbose:
+                logger.info(f" No improvement in {args.early_stopping_metric}")
+                logger.info(f" Current step: {early_stopping_counter}")
+                logger.info(f" Early stopping patience: {args.early_stopping_patience}")
+            return best_eval_metric, early_stopping_counter, False
+
+        if verbose:
+            logger.info(f" Patience of {args.early_stopping_patience} steps reached")
+            logger.info(" Training terminated.")
+        return best_eval_metric, early_stopping_counter, True
+
     def _get_last_metrics(self, metric_values):
         return {metric: values[-1] for metric, values in metric_values.items()}
 
@@ -3529,13 +4166,6 @@ class RetrievalModel:
             )
             self.query_config.save_pretrained(os.path.join(output_dir, "query_encoder"))
 
-            context_model_to_save.save_pretrained(
-                os.path.join(output_dir, "context_encoder")
-            )
-            query_model_to_save.save_pretrained(
-                os.path.join(output_dir, "query_encoder")
-            )
-
             self.context_tokenizer.save_pretrained(
                 os.path.join(output_dir, "context_encoder")
             )
@@ -3544,12 +4174,52 @@ class RetrievalModel:
             )
 
             torch.save(self.args, os.path.join(output_dir, "training_args.bin"))
+
+            if (
+                self.args.quantize_context_encoder
+                and self.args.quantize_dtype == "int8"
+            ):
+                # The packed int8 weights can't be saved or loaded by from_pretrained()
+                context_state_dict = dequantize_state_dict(context_model_to_save)
+            else:
+                context_state_dict = context_model_to_save.state_dict()
+            query_state_dict = query_model_to_save.state_dict()
             if optimizer and scheduler and self.args.save_optimizer_and_scheduler:
-                torch.save(
-                    optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt")
+                optimizer_state_dict = optimizer.state_dict()
+                scheduler_state_dict = scheduler.state_dict()
+            else:
+                optimizer_state_dict = None
+                scheduler_state_dict = None
+
+            if self.args.async_checkpointing:
+                # Only one checkpoint is held in host memory at a time
+                self._wait_for_pending_saves()
+                # Snapshot to CPU on this thread, so that training can continue while the
+                # snapshot is written to disk in the background
+                context_state_dict = copy_to_cpu(context_state_dict)
+                query_state_dict = copy_to_cpu(query_state_dict)
+                optimizer_state_dict = copy_to_cpu(optimizer_state_dict)
+                if self._checkpoint_executor is None:
+                    self._checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+                self._pending_save = self._checkpoint_executor.submit(
+                    self._write_checkpoint,
+                    output_dir,
+                    context_model_to_save,
+                    query_model_to_save,
+                    context_state_dict,
+                    query_state_dict,
+                    optimizer_state_dict,
+                    scheduler_state_dict,
                 )
-                torch.save(
-                    scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt")
+            else:
+                self._write_checkpoint(
+                    output_dir,
+                    context_model_to_save,
+                    query_model_to_save,
+                    context_state_dict,
+                    query_state_dict,
+                    optimizer_state_dict,
+                    scheduler_state_dict,
                 )
 
         if results:
@@ -3559,6 +4229,38 @@ class RetrievalModel:
                 for key in sorted(results.keys()):
                     writer.write("{} = {}\n".format(key, str(results[key])))
 
+    def _write_checkpoint(
+        self,
+        output_dir,
+        context_model,
+        query_model,
+        context_state_dict,
+        query_state_dict,
+        optimizer_state_dict=None,
+        scheduler_state_dict=None,
+    ):
+        context_model.save_pretrained(
+            os.path.join(output_dir, "context_encoder"),
+            state_dict=context_state_dict,
+        )
+        query_model.save_pretrained(
+            os.path.join(output_dir, "query_encoder"), state_dict=query_state_dict
+        )
+        if optimizer_state_dict is not None:
+            save_buffered(
+                optimizer_state_dict, os.path.join(output_dir, "optimizer.pt")
+            )
+        if scheduler_state_dict is not None:
+            save_buffered(
+                scheduler_state_dict, os.path.join(output_dir, "scheduler.pt")
+            )
+
+    def _wait_for_pending_saves(self):
+        if self._pending_save is not None:
+            # Re-raises any exception from the background write
+            self._pending_save.result()
+            self._pending_save = None
+
     def _move_model_to_device(self, is_evaluating=False):
         self.context_encoder.to(self.device)
         self.query_encoder.to(self.device)
@@ -1,12 +1,14 @@
+import io
 import logging
 import math
 import os
 import pickle
 import json
 import random
+import string
 from collections import deque
-from multiprocessing import Pool, cpu_count
-from functools import partial
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache, partial
 from simpletransformers.seq2seq.seq2seq_utils import add_faiss_index_to_dataset
 from simpletransformers.config.model_args import get_default_process_count
 import datasets
@@ -15,13 +17,14 @@ from datasets.load import load_from_disk
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 import transformers
 import numpy as np
 import faiss
 from sklearn.cluster import MiniBatchKMeans
 from sklearn.model_selection import train_test_split
 
-from torch.utils.data import Dataset, IterableDataset
+from torch.utils.data import Dataset, IterableDataset, Sampler
 from tqdm.auto import tqdm
 
 from datasets import Features, Sequence, Value, load_dataset, concatenate_datasets
@@ -32,6 +35,8 @@ from transformers.models.rag.retrieval_rag import Index
 
 logger = logging.getLogger(__name__)
 
+_PUNCT_TABLE = str.maketrans("", "", string.punctuation)
+
 
 # Setting FAISS threads
 # faiss.omp_set_num_threads(get_default_process_count())
@@ -137,8 +142,12 @@ def load_hf_dataset(
     if args.cluster_concatenated:
         dataset = dataset.map(
             lambda x: {
-                "passages_for_clustering": [x["query_text"] + " " + x["gold_passage"]]
+                "passages_for_clustering": [
+                    [query + " " + passage]
+                    for query, passage in zip(x["query_text"], x["gold_passage"])
+                ]
             },
+            batched=True,
         )
 
     n_hard_negatives = args.n_hard_negatives
@@ -400,6 +409,17 @@ def preprocess_batch_for_hf_dataset(
         }
 
 
+def mean_pooling(token_embeddings, attention_mask):
+    """
+    Averages the token embeddings over the unmasked positions.
+    The masked sum is computed as a (batch_size, 1, seq_len) x (batch_size, seq_len, hidden_size)
+    batched matmul so the (batch_size, seq_len, hidden_size) masked copy is never materialized.
+    """
+    mask = attention_mask.unsqueeze(1).to(token_embeddings.dtype)
+    summed = torch.bmm(mask, token_embeddings).squeeze(1)
+    return summed / torch.clamp(mask.sum(-1), min=1e-9)
+
+
 def get_output_embeddings(
     embeddings,
     concatenate_embeddings=False,
@@ -419,15 +439,8 @@ def get_output_embeddings(
             embeddings.last_hidden_state.shape[0], -1
         )
     elif args is not None and args.mean_pooling:
-        token_embeddings = embeddings[
-            0
-        ]  # First element of model_output contains all token embeddings
-        input_mask_expanded = (
-            input_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-        )
-        return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(
-            input_mask_expanded.sum(1), min=1e-9
-        )
+        # First element of model_output contains all token embeddings
+        return mean_pooling(embeddings[0], input_mask)
     else:
         if use_pooler_output:
             return embeddings.pooler_output
@@ -615,7 +628,8 @@ def embed(
                     n_cls_tokens=(1 + extra_cls_token_count),
                 )
 
-    return {"embeddings": embeddings.detach().cpu().numpy()}
+    # Embeddings need to be float32 for indexing (the encoder may be quantized to bf16)
+    return {"embeddings": embeddings.detach().float().cpu().numpy()}
 
 
 def add_hard_negatives_to_evaluation_dataset(dataset):
@@ -722,6 +736,8 @@ def get_evaluation_passage_dataset(
                         ),
                         batched=True,
                         batch_size=args.embed_batch_size,
+                        with_rank=args.n_gpu > 1,
+                        num_proc=args.n_gpu,
                     )
                 else:
                     additional_passages = load_dataset(
@@ -834,6 +850,8 @@ def get_evaluation_passage_dataset(
                 ),
                 batched=True,
                 batch_size=args.embed_batch_size,
+                with_rank=args.n_gpu > 1,
+                num_proc=args.n_gpu,
             )
 
             logger.info("Generating embeddings for evaluation passages completed.")
@@ -1029,22 +1047,27 @@ class DPRIndex(Index):
             raise KeyError(
                 "The dataset must contain a column named 'passage_id' if passages_only is False."
             )
-        vectors = [doc["embeddings"] for doc in docs]
-        for i in range(len(vectors)):
-            if len(vectors[i]) < n_docs:
-                vectors[i] = np.vstack(
-                    [vectors[i], np.zeros((n_docs - len(vectors[i]), self.vector_size))]
-                )
+        # Written into a single zero-padded array instead of padding each query's
+        # vectors with vstack and stacking them again. Queries with fewer than n_docs
+        # results keep zero vectors in the remaining rows.
+        doc_vectors = [np.asarray(doc["embeddings"], dtype=np.float32) for doc in docs]
+        vector_size = next(
+            (v.shape[1] for v in doc_vectors if len(v) > 0), self.vector_size
+        )
+        vectors = np.zeros((len(docs), n_docs, vector_size), dtype=np.float32)
+        for i, doc_vectors_i in enumerate(doc_vectors):
+            if len(doc_vectors_i) > 0:
+                vectors[i, : len(doc_vectors_i)] = doc_vectors_i
         if return_indices:
             return (
                 ids,
-                np.array(vectors),
+                vectors,
                 docs,
             )
         else:
             return (
                 np.array(doc_ids),
-                np.array(vectors),
+                vectors,
                 docs,
             )
 
@@ -1072,10 +1095,11 @@ class DPRIndex(Index):
 
         # Original id order could also be returned here if needed
 
-        # Reorder doc_ids. doc_ids is a list of lists, so numpy indexing is not possible
-        doc_ids_reordered = []
-        for i in range(len(doc_ids)):
-            doc_ids_reordered.append([doc_ids[i][j] for j in rerank_indices[i]])
+        # Reorder doc_ids with a single gather. Every query has the same number of docs
+        # here (compute_rerank_similarity stacks them), so the lists form a 2D array.
+        doc_ids_reordered = np.take_along_axis(
+            np.asarray(doc_ids), rerank_indices, axis=1
+        ).tolist()
 
         return doc_ids_reordered, rerank_similarity_reordered
 
@@ -1094,6 +1118,14 @@ class PrecomputedEmbeddingsDataset(Dataset):
         return len(self.embeddings)
 
 
+def normalize_passage(text, remove_spaces=False):
+    """Lowercases text and strips punctuation (and optionally all spaces) for matching passages"""
+    text = text.strip().lower()
+    if remove_spaces:
+        text = text.replace(" ", "")
+    return text.translate(_PUNCT_TABLE)
+
+
 def mean_reciprocal_rank_at_k(rs, k, return_individual_scores=False):
     """
     Adapted from https://gist.github.com/bwhite/3726239
@@ -1140,6 +1172,137 @@ class ClusteredDataset(Dataset):
         return len(self.clusters)
 
 
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler that puts examples of similar length in the same batch so that less compute is
+    spent on padding. Shuffled indices are split into pools of batch_size * n_buckets examples,
+    each pool is sorted by length and sliced into batches, and the batch order is shuffled.
+    """
+
+    def __init__(self, lengths, batch_size, n_buckets=64):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.n_buckets = n_buckets
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths))
+        batches = []
+        for pool in indices.split(self.batch_size * self.n_buckets):
+            pool = pool[torch.argsort(self.lengths[pool], stable=True)]
+            batches.extend(pool.split(self.batch_size))
+
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i].tolist()
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+
+def get_sequence_lengths(dataset, mask_column="context_mask", chunk_size=10000):
+    """Returns the number of non-padding tokens of each example in a torch formatted dataset"""
+    lengths = [
+        dataset[start : start + chunk_size][mask_column].sum(1)
+        for start in range(0, len(dataset), chunk_size)
+    ]
+    return torch.cat(lengths)
+
+
+@contextmanager
+def maybe_no_sync(models, sync):
+    """
+    Skips the gradient all-reduce of every DistributedDataParallel model in models unless sync
+    is True. Models that are not wrapped in DistributedDataParallel are ignored.
+    """
+    with ExitStack() as stack:
+        if not sync:
+            for model in models:
+                if isinstance(model, DistributedDataParallel):
+                    stack.enter_context(model.no_sync())
+        yield
+
+
+def copy_to_cpu(obj):
+    """Returns a copy of obj where every tensor in (nested) dicts, lists and tuples is copied to the CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: copy_to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(value) for value in obj)
+    return obj
+
+
+def dequantize_state_dict(model):
+    """
+    Returns the state_dict of a model quantized with torch.ao.quantization.quantize_dynamic, with
+    the quantized Linear layers stored as regular float weight and bias tensors so that it can be
+    saved and loaded again with from_pretrained()
+    """
+    state_dict = model.state_dict()
+    for name, module in model.named_modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            prefix = f"{name}." if name else ""
+            for key in [key for key in state_dict if key.startswith(prefix)]:
+                if key[len(prefix) :] in (
+                    "scale",
+                    "zero_point",
+                    "_packed_params.dtype",
+                    "_packed_params._packed_params",
+                ):
+                    del state_dict[key]
+            state_dict[prefix + "weight"] = module.weight().dequantize()
+            if module.bias() is not None:
+                state_dict[prefix + "bias"] = module.bias().detach()
+    return state_dict
+
+
+def record_stream(obj, stream):
+    """
+    Marks every CUDA tensor in (nested) dicts, lists and tuples as used on stream, so that
+    the caching allocator doesn't reuse its memory before the work queued on stream is done
+    """
+    if torch.is_tensor(obj):
+        if obj.is_cuda:
+            obj.record_stream(stream)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            record_stream(value, stream)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            record_stream(value, stream)
+
+
+def prefetch_map(fn, iterable, executor):
+    """
+    Like map(fn, iterable), but fn is already applied to the next item on the executor
+    while the caller works on the current result.
+    """
+    iterator = iter(iterable)
+    try:
+        future = executor.submit(fn, next(iterator))
+    except StopIteration:
+        return
+    for item in iterator:
+        next_future = executor.submit(fn, item)
+        yield future.result()
+        future = next_future
+    yield future.result()
+
+
+def save_buffered(obj, path):
+    """Serializes obj with torch.save into memory first, so that the file is written in a single call"""
+    buffer = io.BytesIO()
+    torch.save(obj, buffer)
+    with open(path, "wb") as f:
+        f.write(buffer.getbuffer())
+
+
+def trim_padding(input_ids, attention_mask):
+    """Drops the trailing positions that are padding in every row of the batch"""
+    max_length = int(attention_mask.sum(1).max())
+    return input_ids[:, :max_length], attention_mask[:, :max_length]
+
+
 # class IterableClusteredDataset(IterableDataset):
 #     def __init__(self, passage_dataset, clustered_batches):
 #         self.passage_dataset = passage_dataset
@@ -2008,12 +2171,15 @@ def compute_rerank_similarity(query_embeddings, doc_dicts, passage_column="passa
     Computes the similarity between the reranking query embeddings and the reranking document embeddings
     for the unified reranking method using dot product.
     """
-    rerank_similarity = np.zeros((len(doc_dicts), len(doc_dicts[0][passage_column])))
-    for i, doc_dict in enumerate(doc_dicts):
-        rerank_similarity[i] = np.dot(
-            query_embeddings[i], np.array(doc_dict["rerank_embeddings"]).T
-        )
-    return rerank_similarity
+    # (n_queries, n_docs, dim) @ (n_queries, dim, 1) as a single batched matmul
+    rerank_embeddings = np.stack(
+        [
+            np.asarray(doc_dict["rerank_embeddings"], dtype=np.float32)
+            for doc_dict in doc_dicts
+        ]
+    )
+    query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+    return np.matmul(rerank_embeddings, query_embeddings[:, :, None])[:, :, 0]
 
 
 class RetrievalOutput:
@@ -2057,6 +2223,49 @@ class MarginMSELoss(nn.Module):
         return loss
 
 
+def fake_quantize(embeddings, precision):
+    """
+    Rounds embeddings to the given precision ("int8" with a symmetric per-row scale, or
+    "binary") while letting gradients pass through unchanged (straight-through estimator).
+    """
+    if precision == "int8":
+        scale = embeddings.detach().abs().amax(dim=-1, keepdim=True) / 127
+        scale = scale.clamp_min(1e-8)
+        quantized = torch.round(embeddings / scale).clamp(-127, 127) * scale
+    elif precision == "binary":
+        quantized = torch.sign(embeddings)
+    else:
+        raise ValueError(
+            "QAT precision must be 'int8' or 'binary'. Got {}".format(precision)
+        )
+    return embeddings + (quantized - embeddings).detach()
+
+
+def _triplet_margin_loss(anchor, positive, negative, margin):
+    positive_distance = torch.linalg.vector_norm(anchor - positive + 1e-6, dim=-1)
+    negative_distance = torch.linalg.vector_norm(anchor - negative + 1e-6, dim=-1)
+    return torch.clamp_min(margin + positive_distance - negative_distance, 0).mean()
+
+
+@lru_cache(maxsize=None)
+def _compiled_triplet_margin_loss():
+    return torch.compile(_triplet_margin_loss, dynamic=True)
+
+
+def fused_triplet_margin_loss(anchor, positive, negative, margin=1.0):
+    """
+    Same as torch.nn.functional.triplet_margin_loss with the default L2 distance and mean
+    reduction, but compiled with torch.compile so that both distance reductions, the
+    margin and the ReLU run as a single fused (Triton, on GPUs) kernel over the embeddings.
+    """
+    return _compiled_triplet_margin_loss()(
+        anchor.contiguous(),
+        positive.contiguous(),
+        negative.contiguous(),
+        margin,
+    )
+
+
 class KLDivLossForTriplets(nn.Module):
     def __init__(self):
         super(KLDivLossForTriplets, self).__init__()